@@ -24,12 +24,52 @@ virtualenv heat-venv
 set +u && source heat-venv/bin/activate && set -u
 pip install python-heatclient fabric
 
-ssh-keygen -t rsa -P '' -C manila-management -f ${MANAGEMENT_KEY_PATH}
+# The key is kept if present: leased deployments (STACK_LEASE) are only
+# reachable with the key they were deployed with.
+[[ -f ${MANAGEMENT_KEY_PATH} ]] || \
+    ssh-keygen -t rsa -P '' -C manila-management -f ${MANAGEMENT_KEY_PATH}
+
+# Serve packages to the deployment through a local caching proxy, if asked
+# to: PACKAGE_PROXY is its URL as seen from the deployed hosts, it listens
+# on that address and port only (see pkgcache.py). It proxies
+# packages.scality.com, and the hosts of PACKAGE_PROXY_HOSTS (space
+# separated, eg distro mirrors). 50-teardown.sh stops it.
+PKGCACHE_PID=/tmp/manilaci-pkgcache.pid
+if [[ -n "${PACKAGE_PROXY:-}" ]]; then
+    PKGCACHE_OPTS=""
+    for host in ${PACKAGE_PROXY_HOSTS:-}; do
+        PKGCACHE_OPTS+=" --allow ${host}"
+    done
+    # A proxy left by an aborted run is replaced.
+    if [[ -f ${PKGCACHE_PID} ]]; then
+        kill $(cat ${PKGCACHE_PID}) || true
+    fi
+    PACKAGE_PROXY=${PACKAGE_PROXY} nohup python pkgcache.py ${PKGCACHE_OPTS} \
+        > /tmp/manilaci-pkgcache.log 2>&1 &
+    echo $! > ${PKGCACHE_PID}
+fi
 
 # Remove any deployed resources on error.
 trap "fab destroy" ERR
 
 # Connection attempts are bumped here to give sshd time to
 # start on the deployed infrastructure.
-fab deploy:"`cat ${MANAGEMENT_KEY_PATH}.pub`,${IMAGE}" --connection-attempts 10 \
-	-i ${MANAGEMENT_KEY_PATH} -u ${MANAGEMENT_USER}
+FAB_OPTS="--connection-attempts 10 -i ${MANAGEMENT_KEY_PATH}"
+FAB_OPTS+=" -u ${MANAGEMENT_USER}"
+PUBLIC_KEY=$(cat ${MANAGEMENT_KEY_PATH}.pub)
+
+# Number of storage nodes and connectors of the deployment.
+TOPOLOGY="nodes=${RING_NODES:-1}"
+TOPOLOGY+=",nfs_connectors=${NFS_CONNECTORS:-1}"
+TOPOLOGY+=",cifs_connectors=${CIFS_CONNECTORS:-1}"
+
+# A failed deployment is resumed once on the same stack, before giving up.
+# With STACK_LEASE=yes, a deployment kept from an earlier run is claimed
+# instead, see `fab -d lease`.
+if [[ "${STACK_LEASE:-no}" == "yes" ]]; then
+    fab lease:"${PUBLIC_KEY},${IMAGE},${TOPOLOGY}" ${FAB_OPTS} \
+        || fab resume ${FAB_OPTS}
+else
+    fab deploy:"${PUBLIC_KEY},${IMAGE},streaming=yes,${TOPOLOGY}" \
+        ${FAB_OPTS} || fab resume ${FAB_OPTS}
+fi
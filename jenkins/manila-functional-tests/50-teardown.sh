@@ -5,4 +5,14 @@ SCRIPT_DIR=$(dirname ${0})
 cd ${SCRIPT_DIR}
 
 set +u && source heat-venv/bin/activate && set -u
-fab destroy
+
+# Stop the package proxy started by 10-deploy-ring.sh, if any.  Lease
+# builds left running in the background do not use it, see fabfile.py.
+PKGCACHE_PID=/tmp/manilaci-pkgcache.pid
+if [[ -f ${PKGCACHE_PID} ]]; then
+    kill $(cat ${PKGCACHE_PID}) || true
+    rm -f ${PKGCACHE_PID}
+fi
+
+# Leased deployments are kept for later runs, others are destroyed.
+fab release
@@ -1,15 +1,24 @@
 
+import base64
+import contextlib
 import io
 import json
 import os
+import pipes
 import re
-import time
+import shutil
+import socket
+import tempfile
+import uuid
 import yaml
 
-from fabric.api import env, execute, get, put, run, sudo
+from fabric.api import abort, env, execute, get, put, run, sudo
 from fabric.context_managers import hide, settings, shell_env
 from fabric.contrib.files import append, sed, upload_template
 
+import ringsh
+import waits
+
 CREDENTIALS = {
     'supuser': 'supadmin',
     'suppass': 'suppass',
@@ -18,23 +27,335 @@ CREDENTIALS = {
 }
 
 
-def memoize(f):
+# Hosts whose package downloads go through the package proxy, if any:
+# packages.scality.com, and the space separated hosts of
+# PACKAGE_PROXY_HOSTS, such as distro mirrors (apt only).  The proxy must
+# allow them, see pkgcache.py.
+PROXIED_HOSTS = ('packages.scality.com',) + tuple(
+    os.environ.get('PACKAGE_PROXY_HOSTS', '').split())
+
+# Directory holding the host facts of each deployment, see
+# `use_deployment_facts`.
+FACTS_ROOT = '/tmp/manilaci-facts'
+
+# Directory where host facts of the current deployment are cached, shared
+# by the processes of parallel tasks.
+FACTS_DIR = os.path.join(FACTS_ROOT, 'default')
+
+# Commands looked up on hosts by `host_facts`.
+FACT_COMMANDS = (
+    'apt-get', 'yum', 'systemctl', 'sfused', 'sagentd-manageconf',
+    'scality-node-config', 'ringsh',
+)
+
+_facts = {}
+
+
+def use_deployment_facts(deployment):
+    """
+    Cache host facts in a directory of their own for a deployment, apart
+    from those of other deployments done from this host.
+
+    Processes started afterwards, such as deployment stages, inherit it.
+
+    :param deployment: deployment identifier, such as its stack id
+    :type deployment: string
+    """
+    global FACTS_DIR
+    FACTS_DIR = _deployment_facts_dir(deployment)
+    _facts.clear()
+
+
+def _deployment_facts_dir(deployment):
+    return os.path.join(FACTS_ROOT, re.sub(r'[^\w.-]', '_', deployment))
+
+
+def _facts_path(host_string):
+    return os.path.join(FACTS_DIR, re.sub(r'[^\w.-]', '_', host_string))
+
+
+def _write_fact_file(path, data):
+    """
+    Write a JSON fact file, so that concurrent readers see either the
+    previous content or the new one.
+    """
+    if not os.path.isdir(FACTS_DIR):
+        try:
+            os.makedirs(FACTS_DIR)
+        except OSError:
+            # Created concurrently by another process.
+            if not os.path.isdir(FACTS_DIR):
+                raise
+    fd, temp_path = tempfile.mkstemp(dir=FACTS_DIR, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(data, f)
+        os.rename(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def host_facts():
+    """
+    Get facts about the current host, collected in a single remote call.
+
+    Facts are cached per host, in process and on disk, so that processes
+    of parallel tasks do not probe hosts again.  Facts are:
+     - which: dict of the path of each of `FACT_COMMANDS`, or an empty string
+     - hostname: host name
+     - redhat_release: content of /etc/redhat-release, or an empty string
+
+    :return: dict
+    """
+    host_string = env.host_string
+    if host_string in _facts:
+        return _facts[host_string]
+
+    path = _facts_path(host_string)
+    try:
+        with io.open(path, 'rb') as f:
+            _facts[host_string] = json.load(f)
+        return _facts[host_string]
+    except (IOError, ValueError):
+        pass
+
+    script = '; '.join(
+        ['echo "which {0:s} $(which {0:s} 2>/dev/null)"'.format(command)
+         for command in FACT_COMMANDS] +
+        ['echo "hostname $(hostname)"',
+         'echo "redhat_release $(cat /etc/redhat-release 2>/dev/null)"'])
+    with settings(hide('stdout')):
+        output = run(script)
+
+    facts = {'which': {}}
+    for line in output.splitlines():
+        fields = line.strip().split(' ', 1) + ['']
+        if fields[0] == 'which':
+            command, _, command_path = fields[1].partition(' ')
+            facts['which'][command] = command_path
+        else:
+            facts[fields[0]] = fields[1]
+
+    _write_fact_file(path, facts)
+    _facts[host_string] = facts
+    return facts
+
+
+def invalidate_facts():
+    """
+    Forget facts of the current host, after a change of its state.
+    """
+    _facts.pop(env.host_string, None)
+    try:
+        os.unlink(_facts_path(env.host_string))
+    except OSError:
+        pass
+
+
+def clear_facts(deployment=None):
+    """
+    Forget facts of all hosts of a deployment, for instance at its start.
+    Facts of other deployments are kept.
+
+    This also forgets the package operations done on hosts.
+
+    :param deployment: deployment whose facts to forget, see
+        `use_deployment_facts` (optional) by default the current one
+    :type deployment: string
+    """
+    if deployment is None:
+        _facts.clear()
+        shutil.rmtree(FACTS_DIR, ignore_errors=True)
+    else:
+        shutil.rmtree(_deployment_facts_dir(deployment), ignore_errors=True)
+
+
+def which(command):
+    """
+    Get the path of a command on the current host.
+
+    :param command: one of `FACT_COMMANDS`
+    :type command: string
+    :return: string
     """
-    Decorator providing results caching.
+    command_path = host_facts()['which'][command]
+    if not command_path:
+        raise Exception('{0:s} not found on {1:s}'.format(
+            command, env.host_string))
+    return command_path
 
-    This is a rather naive approach which relies on the string representation
-    of the arguments.  If a type of an argument does not implement `repr`,
-    caching of calls will be guaranteed.
+
+class CommandResult(str):
+    """
+    Output of a batched command, with the attributes of fabric results.
     """
-    f.memoized_result = {}
+    command = None
+    return_code = None
 
-    def wrapper(*args, **kwargs):
-        cache_key = repr(args) + repr(kwargs)
-        if cache_key not in f.memoized_result:
-            f.memoized_result[cache_key] = f(*args, **kwargs)
-        return f.memoized_result[cache_key]
+    @property
+    def succeeded(self):
+        return self.return_code == 0
 
-    return wrapper
+    @property
+    def failed(self):
+        return not self.succeeded
+
+
+class BatchedCommand(object):
+    """
+    Command queued in a :py:class:`Batch`, its `result` is set once the
+    batch has run.
+    """
+
+    def __init__(self, command, warn_only):
+        self.command = command
+        self.warn_only = warn_only
+        self.result = None
+
+
+# Shell function wrapping each command of a batch.  Commands run in the
+# same shell, so that they can share variables, and their output is sent
+# back base64 encoded on a single line, tagged with the command index and
+# exit status.  The exit trap reports a command which exits the shell.
+BATCH_PRELUDE = """
+__batch_out=$(mktemp)
+exec 9>&1
+__batch_report() {{
+    echo "{marker:s} $1 $2 $(base64 -w0 <"$__batch_out")" >&9
+}}
+__batch_exit() {{
+    __batch_rc=$?
+    if [ -n "$__batch_index" ]; then
+        __batch_report "$__batch_index" "$__batch_rc"
+    fi
+    rm -f "$__batch_out"
+}}
+trap __batch_exit EXIT
+__batch_run() {{
+    __batch_index=$1
+    eval "$2" </dev/null >"$__batch_out" 2>&1
+    __batch_rc=$?
+    __batch_index=
+    __batch_report "$1" "$__batch_rc"
+    return $__batch_rc
+}}
+"""
+
+
+class Batch(object):
+    """
+    Commands to run with sudo as a single script, in a single remote call.
+
+    Commands run in order.  The script stops at the first failing command,
+    unless that command was queued with `warn_only`.
+    """
+
+    def __init__(self):
+        self.commands = []
+
+    def sudo(self, command, warn_only=False):
+        """
+        Queue a command.
+
+        :param command: shell command
+        :type command: string
+        :param warn_only: whether a failure of the command is tolerated
+        :type warn_only: bool
+        :return: :py:class:`BatchedCommand`
+        """
+        queued = BatchedCommand(command, warn_only)
+        self.commands.append(queued)
+        return queued
+
+    def flush(self):
+        """
+        Run queued commands, and set their results.
+
+        Commands not run because of an earlier failure get no result.
+        Aborts on failure of a command not queued with `warn_only`, unless
+        `env.warn_only` is set.
+        """
+        commands, self.commands = self.commands, []
+        if not commands:
+            return
+
+        marker = 'BATCH-{0:s}'.format(uuid.uuid4().hex)
+        lines = [BATCH_PRELUDE.format(marker=marker)]
+        for index, queued in enumerate(commands):
+            line = '__batch_run {0:d} {1:s}'.format(
+                index, pipes.quote(queued.command))
+            if not queued.warn_only:
+                line += ' || exit 0'
+            lines.append(line)
+        script = base64.b64encode('\n'.join(lines))
+
+        with settings(hide('running', 'stdout')):
+            output = sudo('bash -c "$(echo {0:s} | base64 -d)"'.format(
+                script))
+
+        for line in output.splitlines():
+            fields = line.strip().split(' ')
+            if fields[0] != marker:
+                continue
+            queued = commands[int(fields[1])]
+            result = CommandResult(base64.b64decode(
+                fields[3] if len(fields) > 3 else '').rstrip('\n'))
+            result.command = queued.command
+            result.return_code = int(fields[2])
+            queued.result = result
+
+        for queued in commands:
+            if queued.result is None:
+                print('[{0:s}] batch: {1:s} (not run)'.format(
+                    env.host_string, queued.command))
+                continue
+            print('[{0:s}] batch: {1:s} (exit {2:d})'.format(
+                env.host_string, queued.command, queued.result.return_code))
+            if queued.result:
+                print(queued.result)
+            if queued.result.failed and not queued.warn_only:
+                message = 'Batched command failed: {0:s}'.format(
+                    queued.command)
+                if env.warn_only:
+                    print('Warning: ' + message)
+                else:
+                    abort(message)
+
+
+_batch = None
+
+
+@contextlib.contextmanager
+def batch():
+    """
+    Collect the commands of bootstrap helpers, and run them in a single
+    remote call when the block exits.
+
+    Helpers called within the block queue their commands instead of running
+    them.  Results are available from the yielded :py:class:`Batch` queue
+    results once the block exited.  Nested blocks join the outermost batch.
+    """
+    global _batch
+    if _batch is not None:
+        yield _batch
+        return
+
+    current = _batch = Batch()
+    try:
+        yield current
+    finally:
+        _batch = None
+    current.flush()
+
+
+def _sudo(command, warn_only=False):
+    """
+    Run a command with sudo, or queue it in the current batch if any.
+    """
+    if _batch is not None:
+        return _batch.sudo(command, warn_only=warn_only)
+    return sudo(command, warn_only=warn_only)
 
 
 def update_yaml(path, predicate, update, use_sudo=False):
@@ -72,6 +393,33 @@ def abspath(path):
     return os.path.abspath(os.path.join(local_path, path))
 
 
+def wait_for_ssh(host, port=22, timeout=300):
+    """
+    Wait until sshd on a host accepts connections and sends its banner.
+
+    :param host: hostname or ip to probe
+    :type host: string
+    :param port: ssh port
+    :type port: int
+    :param timeout: seconds to wait before giving up
+    :type timeout: int
+    """
+    def probe():
+        sock = socket.create_connection((host, port), timeout=5)
+        try:
+            return sock.recv(256).startswith(b'SSH-')
+        finally:
+            sock.close()
+
+    waits.wait(
+        probe,
+        'ssh on {0:s}:{1:d}'.format(host, port),
+        retriable=lambda error: True,
+        timeout=timeout,
+        max_interval=10,
+    )
+
+
 def add_apt_repositories(credentials, release):
     """
     Add Scality APT repositories.
@@ -103,10 +451,10 @@ def add_apt_repositories(credentials, release):
 
     # Sagentd depends on snmp-mibs-downloader, which is in multiverse.
     sudo('apt-add-repository --enable-source multiverse')
-    sudo('apt-get -q update')
+    update_package_index()
 
 
-def add_rpm_repositories(credentials, release, add_epel=True):
+def add_rpm_repositories(credentials, release, add_epel=True, proxy=None):
     """
     Add Scality Centos repositories.
 
@@ -116,12 +464,12 @@ def add_rpm_repositories(credentials, release, add_epel=True):
     :type release: string
     :param add_epel: whether to add the EPEL package repository
     :type add_epel: bool
+    :param proxy: URL of an HTTP proxy for the Scality repository
+        (optional)
+    :type proxy: string
     """
     pattern = re.compile(r'^CentOS.*release (?P<major>\d+)[.]')
-    version_string = io.BytesIO()
-    get('/etc/redhat-release', local_path=version_string)
-
-    match = pattern.match(version_string.getvalue())
+    match = pattern.match(host_facts()['redhat_release'])
     if match is None:
         raise Exception('Unable to get CentOS version')
 
@@ -141,7 +489,7 @@ def add_rpm_repositories(credentials, release, add_epel=True):
 
     # Add epel repository.
     if add_epel:
-        sudo('rpm -Uvh {0:s}'.format(epel))
+        sudo('rpm -q epel-release || rpm -Uvh {0:s}'.format(epel))
 
     # Add scality repository.
     upload_template(
@@ -151,44 +499,152 @@ def add_rpm_repositories(credentials, release, add_epel=True):
             'credentials': credentials,
             'release': release,
             'centos_version': version,
+            'proxy': proxy or '_none_',
         },
         use_sudo=True,
     )
 
 
-@memoize
 def get_package_manager():
     """
     Detect OS package manager.
 
     :return: string
     """
-    if run('which apt-get', warn_only=True).succeeded:
+    facts = host_facts()
+    if facts['which']['apt-get']:
         return 'apt'
-    elif run('which yum', warn_only=True).succeeded:
+    elif facts['which']['yum']:
         return 'yum'
 
     raise Exception('Unable to detect package manager')
 
 
+def _packages_path(host_string):
+    return _facts_path(host_string) + '.packages'
+
+
+def _package_state():
+    """
+    Get the package operations done on the current host during this
+    deployment, kept next to host facts and cleared with them.
+    """
+    try:
+        with io.open(_packages_path(env.host_string), 'rb') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {'installed': [], 'index_updated': False}
+
+
+def _save_package_state(state):
+    _write_fact_file(_packages_path(env.host_string), state)
+
+
+def update_package_index():
+    """
+    Update the APT package index, at most once per host and deployment.
+    """
+    if get_package_manager() != 'apt':
+        return
+
+    state = _package_state()
+    if state['index_updated']:
+        return
+    sudo('apt-get -q update')
+    state['index_updated'] = True
+    _save_package_state(state)
+
+
+_transaction = None
+
+
+@contextlib.contextmanager
+def package_transaction():
+    """
+    Collect the packages to install within the block, and install them in a
+    single package manager invocation when the block exits.
+
+    Nested blocks join the outermost transaction.
+    """
+    global _transaction
+    if _transaction is not None:
+        yield _transaction
+        return
+
+    packages = _transaction = []
+    try:
+        yield packages
+    finally:
+        _transaction = None
+    install_packages(*packages)
+
+
 def install_packages(*args):
     """
     Use the OS specific package manager to install packages.
 
+    Packages already installed on the host during this deployment are
+    skipped.  Within :py:func:`package_transaction`, packages are only
+    queued.
+
     :param args: variable argument list of package names to install
     :type args: argument list of strings
     """
+    if _transaction is not None:
+        _transaction.extend(
+            name for name in args if name not in _transaction)
+        return
+
+    state = _package_state()
+    packages = [name for name in args if name not in state['installed']]
+    if not packages:
+        return
+
     cmd = "{pkgman:s} install -y {packages:s}".format(
         pkgman=get_package_manager(),
-        packages=" ".join(args),
+        packages=" ".join(packages),
     )
-    sudo(cmd)
+    try:
+        with shell_env(DEBIAN_FRONTEND='noninteractive'):
+            sudo(cmd)
+    finally:
+        # Packages may provide commands looked up by facts.
+        invalidate_facts()
+    state['installed'].extend(packages)
+    _save_package_state(state)
+
+
+def packages_installed(*args):
+    """
+    Check whether packages are installed.
+
+    :param args: variable argument list of package names
+    :type args: argument list of strings
+    :return: bool
+    """
+    if get_package_manager() == 'apt':
+        cmd = 'dpkg -s {0:s}'
+    else:
+        cmd = 'rpm -q {0:s}'
+    with settings(hide('everything')):
+        return run(cmd.format(' '.join(args)), warn_only=True).succeeded
+
+
+def processes_running(*args):
+    """
+    Check whether processes run, by exact name.
+
+    :param args: variable argument list of process names
+    :type args: argument list of strings
+    :return: bool
+    """
+    cmd = ' && '.join('pgrep -x {0:s}'.format(name) for name in args)
+    with settings(hide('everything')):
+        return run(cmd, warn_only=True).succeeded
 
 
-@memoize
 def has_systemd():
-    systemd = run('which systemctl', warn_only=True)
-    return systemd.succeeded
+    return bool(host_facts()['which']['systemctl'])
 
 
 def start_service(name):
@@ -199,9 +655,9 @@ def start_service(name):
     :type name: string
     """
     if has_systemd():
-        sudo('systemctl start {0:s}'.format(name))
+        _sudo('systemctl start {0:s}'.format(name))
     else:
-        sudo('/etc/init.d/{0:s} start'.format(name))
+        _sudo('/etc/init.d/{0:s} start'.format(name))
 
 
 def restart_service(name):
@@ -212,9 +668,9 @@ def restart_service(name):
     :type name: string
     """
     if has_systemd():
-        sudo('systemctl restart {0:s}'.format(name))
+        _sudo('systemctl restart {0:s}'.format(name))
     else:
-        sudo('/etc/init.d/{0:s} restart'.format(name))
+        _sudo('/etc/init.d/{0:s} restart'.format(name))
 
 
 def relax_security():
@@ -223,11 +679,12 @@ def relax_security():
 
     Firewall and SELinux is (sometimes) configured by default on CentOS.
     """
-    sudo('iptables -P INPUT ACCEPT')
-    sudo('iptables -F INPUT')
+    with batch():
+        _sudo('iptables -P INPUT ACCEPT')
+        _sudo('iptables -F INPUT')
 
-    # If selinux happens to be deactivated already, it will exit non-zero
-    sudo('setenforce 0', warn_only=True)
+        # If selinux happens to be deactivated already, it will exit non-zero
+        _sudo('setenforce 0', warn_only=True)
 
 
 def initial_host_config():
@@ -246,13 +703,36 @@ def initial_host_config():
         )
 
     # Sudo is noisy if it can't resolve local hostname.
-    hostname = run('hostname')
+    hostname = host_facts()['hostname']
     ping = run('ping {0:s}'.format(hostname), warn_only=True)
     if not ping.succeeded:
         append('/etc/hosts', '127.0.1.1 {0:s}'.format(hostname), use_sudo=True)
 
 
-def add_package_repositories(credentials, release='stable_lorien'):
+def configure_package_proxy(proxy):
+    """
+    Route APT downloads from `PROXIED_HOSTS` through an HTTP proxy, such as
+    the caching proxy of `pkgcache.py`.  Other hosts are reached directly.
+
+    With yum, only the Scality repository goes through the proxy, see
+    `add_rpm_repositories`.
+
+    :param proxy: proxy URL, eg http://10.0.0.1:3142
+    :type proxy: string
+    """
+    if get_package_manager() != 'apt':
+        return
+    put(
+        io.BytesIO(''.join(
+            'Acquire::http::Proxy::{0:s} "{1:s}";\n'.format(host, proxy)
+            for host in PROXIED_HOSTS)),
+        '/etc/apt/apt.conf.d/01manilaci-proxy',
+        use_sudo=True,
+    )
+
+
+def add_package_repositories(credentials, release='stable_lorien',
+                             proxy=None):
     """
     Add package repositories.
 
@@ -260,11 +740,30 @@ def add_package_repositories(credentials, release='stable_lorien'):
     :type credentials: string
     :param release: RING release
     :type release: string
+    :param proxy: URL of an HTTP proxy for package downloads (optional)
+    :type proxy: string
     """
+    if proxy:
+        configure_package_proxy(proxy)
+
     if get_package_manager() == 'apt':
         add_apt_repositories(credentials, release)
     else:
-        add_rpm_repositories(credentials, release)
+        add_rpm_repositories(credentials, release, proxy=proxy)
+
+
+def listed_servers(listing):
+    """
+    Get the addresses in the output of `supervisor serverList`.
+
+    Addresses are compared whole, so that 10.0.0.1 is not taken for
+    listed when only 10.0.0.12 is.
+
+    :param listing: output of `supervisor serverList`
+    :type listing: string
+    :return: set of the words of the listing, addresses among them
+    """
+    return set(re.split(r'[\s,;:()\[\]{}<>"\'=]+', listing))
 
 
 def register_sagentd(instance_name, ip, port=7084):
@@ -278,10 +777,11 @@ def register_sagentd(instance_name, ip, port=7084):
     :param port: port of the sagent node for registration
     :type port: int
     """
-    server_listing = run('ringsh supervisor serverList')
-    if ip not in server_listing:
-        run('ringsh supervisor serverAdd {name:s}-sa '
-            '{ip:s} {port:d}'.format(name=instance_name, ip=ip, port=port))
+    servers = listed_servers(ringsh.ringsh('supervisor serverList'))
+    if ip not in servers:
+        ringsh.ringsh(
+            'supervisor serverAdd {name:s}-sa {ip:s} {port:d}'.format(
+                name=instance_name, ip=ip, port=port))
 
 
 def create_volume(name, role, devid, connector_ip, connector_port=7002,
@@ -305,15 +805,17 @@ def create_volume(name, role, devid, connector_ip, connector_port=7002,
     :param md_ring: name of the ring backing the volume metadata
     :type md_ring: string
     """
-    run('ringsh supervisor addVolume {name:s} sofs {devid:d} {data_ring:s} 1 '
-        '{md_ring:s} 1'.format(name=name, devid=devid, data_ring=data_ring,
-                               md_ring=md_ring))
-
-    retries = 10
-    for retry in range(retries):
-        time.sleep(5)
-        cmd = run(
-            'ringsh supv2 addVolumeConnector {name:s} {ip:s}:{port:d} '
+    # Every connector of the volume creates it, and so does a resumed
+    # deployment: it is only created by the first one.
+    ringsh.ringsh_once('supervisor addVolume {name:s} sofs {devid:d} '
+                       '{data_ring:s} 1 {md_ring:s} 1'.format(
+                           name=name, devid=devid, data_ring=data_ring,
+                           md_ring=md_ring),
+                       'volume-{0:s}'.format(name))
+
+    def add_connector():
+        return ringsh.ringsh(
+            'supv2 addVolumeConnector {name:s} {ip:s}:{port:d} '
             '{role:s}'.format(
                 name=name,
                 ip=connector_ip,
@@ -322,10 +824,62 @@ def create_volume(name, role, devid, connector_ip, connector_port=7002,
             ),
             warn_only=True,
         )
-        if cmd.succeeded:
-            break
+
+    waits.wait(
+        add_connector,
+        'connector {0:s} added to volume {1:s}'.format(connector_ip, name),
+    )
+
+
+def connector_packages(role):
+    """
+    Get the packages needed by a connector, which can be installed before
+    the supervisor and ring are available.
+
+    :param role: connector role (nfs, cifs, localfs, or dewpoint)
+    :type role: string
+    :return: list of package names
+    """
+    if role == 'dewpoint':
+        packages = ['scality-dewpoint-fcgi', 'nginx']
     else:
-        raise Exception('Unable to add connector to volume {0:s}'.format(name))
+        packages = ['scality-sfused']
+
+    if role == 'nfs':
+        if get_package_manager() == 'apt':
+            packages.append('nfs-common')
+        else:
+            packages.append('nfs-utils')
+    elif role == 'cifs':
+        packages.append('scality-cifs')
+
+    # Required by install_scality_manila_utils.
+    return packages + ['git', 'python-pip']
+
+
+def ring_packages():
+    """
+    Get the packages needed by a host running the supervisor and a storage
+    node.
+
+    :return: list of package names
+    """
+    return ['scality-supervisor'] + node_packages()
+
+
+def node_packages():
+    """
+    Get the packages needed by a host running a storage node.
+
+    :return: list of package names
+    """
+    if get_package_manager() == 'apt':
+        snmp = ['snmp']
+    else:
+        snmp = ['net-snmp', 'net-snmp-utils']
+
+    return ['scality-ringsh'] + snmp + [
+        'scality-node', 'scality-sagentd', 'scality-nasdk-tools']
 
 
 def setup_sfused(name, supervisor_host, dewpoint=False):
@@ -359,9 +913,11 @@ def setup_sfused(name, supervisor_host, dewpoint=False):
         use_sudo=True,
     )
 
-    manageconf_path = run('which sagentd-manageconf')  # Required for CentOS
+    manageconf_path = which('sagentd-manageconf')  # Required for CentOS
 
+    # The connector is already there when a deployment is resumed.
     sudo(
+        'grep -q {name:s} /etc/sagentd.yaml || '
         '{manageconf:s} -c /etc/sagentd.yaml add {name:s} '
         'type=sfused port=7002 address={host:s} '
         'path={sysfs:s}'.format(
@@ -415,25 +971,21 @@ def setup_connector(role, volume_name, devid, supervisor_host,
     execute(create_volume, volume_name, transport, devid, env.host,
             data_ring=data_ring, md_ring=md_ring, host=supervisor_host)
 
-    sfused = run('which sfused')  # Required for CentOS
+    sfused = which('sfused')  # Required for CentOS
 
     # There is a delay until the sfused config is pushed after volume creation.
-    retries = 10
-    for retry in range(retries):
-        time.sleep(5)
-        cmd = sudo(
+    waits.wait(
+        lambda: sudo(
             command='{0:s} -X -c {1:s}'.format(sfused, conf),
             warn_only=True,
-        )
-        if cmd.succeeded:
-            break
-    else:
-        raise Exception("Catalog init failed for '{0:s}'".format(volume_name))
+        ),
+        "catalog init of '{0:s}'".format(volume_name),
+    )
 
     restart_service(service_name)
 
 
-def setup_nfs_connector(volume_name, devid, supervisor_host):
+def setup_nfs_connector(volume_name, devid, supervisor_host, name='nfs'):
     """
     Deploy an sfused nfs connector and SOFS accompanying volume.
 
@@ -445,6 +997,9 @@ def setup_nfs_connector(volume_name, devid, supervisor_host):
     :param supervisor_host: hostname or ip of the supervisor for registration
         of connector and volume
     :type supervisor_host: string
+    :param name: name of connector, unique among the connectors registered
+        at the supervisor
+    :type name: string
     """
     if get_package_manager() == 'apt':
         install_packages('nfs-common')
@@ -452,12 +1007,12 @@ def setup_nfs_connector(volume_name, devid, supervisor_host):
         install_packages('nfs-utils')
         start_service('rpcbind')
 
-    setup_connector('nfs', volume_name, devid, supervisor_host)
+    setup_connector('nfs', volume_name, devid, supervisor_host, name=name)
     put('assets/connector/etc/exports.conf', '/etc/', use_sudo=True)
     restart_service('scality-sfused')
 
 
-def setup_cifs_connector(volume_name, devid, supervisor_host):
+def setup_cifs_connector(volume_name, devid, supervisor_host, name='cifs'):
     """
     Deploy an sfused cifs connector and SOFS accompanying volume.
 
@@ -469,8 +1024,11 @@ def setup_cifs_connector(volume_name, devid, supervisor_host):
     :param supervisor_host: hostname or ip of the supervisor for registration
         of connector and volume
     :type supervisor_host: string
+    :param name: name of connector, unique among the connectors registered
+        at the supervisor
+    :type name: string
     """
-    setup_connector('cifs', volume_name, devid, supervisor_host)
+    setup_connector('cifs', volume_name, devid, supervisor_host, name=name)
 
     install_packages('scality-cifs')
     conf_path = abspath('assets/connector/etc/samba/smb.conf')
@@ -580,17 +1138,69 @@ def setup_supervisor(ring='MyRing'):
     install_packages('scality-supervisor')
 
     if get_package_manager() == 'yum':
-        start_service('httpd')
-        start_service('scality-supervisor')
-        if has_systemd():
-            start_service('scality-supv2')
+        with batch():
+            start_service('httpd')
+            start_service('scality-supervisor')
+            if has_systemd():
+                start_service('scality-supv2')
 
     setup_ringsh(ring, env.host)
 
 
+# Shell functions of fake_disk.  A disk whose mount point is mounted and
+# flagged for biziod is left alone, and each step is skipped when its
+# outcome is already there, so that reruns are cheap.
+FAKE_DISK_FUNCTIONS = """
+__fake_disk_attach() {
+    if mountpoint -q "$3" && [ -e "$3/.ok_for_biziod" ]; then
+        return 0
+    fi
+    mkdir -p "$3" || return 1
+    [ -e "$1" ] || truncate -s "$2"G "$1" || return 1
+    __fake_disk_dev=$(losetup -j "$1" | cut -d: -f1 | head -n 1)
+    if [ -z "$__fake_disk_dev" ]; then
+        __fake_disk_dev=$(losetup -f --show "$1") || return 1
+    fi
+    echo "$__fake_disk_dev"
+}
+__fake_disk_mount() {
+    [ -n "$1" ] || return 0
+    if [ "$(blkid -p -s TYPE -o value "$1")" != ext4 ]; then
+        mkfs.ext4 -q -m 0 -E lazy_itable_init=1,lazy_journal_init=1 "$1" \\
+            || return 1
+    fi
+    mountpoint -q "$2" || mount "$1" "$2" || return 1
+    touch "$2/.ok_for_biziod"
+}
+"""
+
+
+def disks_healthy(prefix='/scality/disk', quantity=1):
+    """
+    Check whether disks set up by :py:func:`fake_disk` are in place.
+
+    :param prefix: mount prefix of the disks
+    :type prefix: string
+    :param quantity: number of disks
+    :type quantity: int
+    :return: bool
+    """
+    cmd = ' && '.join(
+        'mountpoint -q {0:s}{1:d} && [ -e {0:s}{1:d}/.ok_for_biziod ]'.format(
+            prefix, i)
+        for i in range(1, quantity + 1))
+    with settings(hide('everything')):
+        return run(cmd, warn_only=True).succeeded
+
+
 def fake_disk(prefix='/scality/disk', quantity=1, size=40):
     """
-    Setup a loop device, backed by a sparse file to serve as disk.
+    Setup loop devices, backed by sparse files to serve as disks.
+
+    Loop devices are attached one after the other with `losetup -f --show`,
+    which picks and attaches a free device at once, then formatted and
+    mounted concurrently.  Inode tables and journal are initialized lazily
+    by the kernel once mounted.  Disks already set up are skipped.
 
     :param prefix: mount prefix of the disks
     :type prefix: string
@@ -600,17 +1210,29 @@ def fake_disk(prefix='/scality/disk', quantity=1, size=40):
     :type size: int
     """
     loop_path = '/var/fakedisk'
-    sudo('mkdir -p {0:s}'.format(loop_path))
+    disks = []
     for i in range(1, quantity + 1):
-        mount_point = '{0:s}{1:d}'.format(prefix, i)
-        backing_file = '{0:s}/{1:d}'.format(loop_path, i)
-        sudo('mkdir -p {0:s}'.format(mount_point))
-        sudo('truncate -s {0:d}G {1:s}'.format(size, backing_file))
-        dev = sudo('losetup -f')
-        sudo('losetup {0:s} {1:s}'.format(dev, backing_file))
-        sudo('mkfs.ext4 -m 0 {0:s}'.format(dev))
-        sudo('mount {0:s} {1:s}'.format(dev, mount_point))
-        sudo('touch {0:s}/.ok_for_biziod'.format(mount_point))
+        disks.append((
+            '{0:s}/{1:d}'.format(loop_path, i),
+            '{0:s}{1:d}'.format(prefix, i),
+        ))
+
+    mount = ['__fake_disk_pids=']
+    with batch():
+        _sudo(FAKE_DISK_FUNCTIONS)
+        _sudo('mkdir -p {0:s}'.format(loop_path))
+        for i, (backing_file, mount_point) in enumerate(disks):
+            # Batched commands share their shell, hence the variables.
+            _sudo('__fake_disk_{0:d}=$(__fake_disk_attach {1:s} {2:d} '
+                  '{3:s})'.format(i, backing_file, size, mount_point))
+            mount.append('__fake_disk_mount "$__fake_disk_{0:d}" {1:s} & '
+                         '__fake_disk_pids="$__fake_disk_pids $!"'.format(
+                             i, mount_point))
+        mount.append('__fake_disk_rc=0')
+        mount.append('for pid in $__fake_disk_pids; do '
+                     'wait $pid || __fake_disk_rc=1; done')
+        mount.append('[ $__fake_disk_rc -eq 0 ]')
+        _sudo('\n'.join(mount))
 
 
 def setup_node(supervisor_host, prefix='/scality/disk', metadisks=None,
@@ -628,11 +1250,25 @@ def setup_node(supervisor_host, prefix='/scality/disk', metadisks=None,
     :param ring: name of ring to create
     :type ring: string
     """
-    if get_package_manager() == 'apt':
-        install_packages('snmp')
-    else:
-        install_packages('net-snmp', 'net-snmp-utils')
+    install_node(supervisor_host, prefix, metadisks, ring)
+    join_nodes(supervisor_host, [env.host], ring)
+
+
+def install_node(supervisor_host, prefix='/scality/disk', metadisks=None,
+                 ring='MyRing'):
+    """
+    Install and configure a store node, to be joined to a ring by
+    :py:func:`join_nodes`.
 
+    :param supervisor_host: hostname or ip of the supervisor
+    :type supervisor_host: string
+    :param prefix: mount prefix of the disks (optional)
+    :type prefix: string
+    :param metadisks: mount prefix for bizobj.bin metadata (optional)
+    :type metadisks: string
+    :param ring: name of the ring of the node
+    :type ring: string
+    """
     put_installation_credentials()
     upload_template(
         filename=abspath('assets/node/preseed'),
@@ -646,11 +1282,9 @@ def setup_node(supervisor_host, prefix='/scality/disk', metadisks=None,
     )
 
     # Install node.
-    with shell_env(DEBIAN_FRONTEND='noninteractive'):
-        install_packages('scality-node', 'scality-sagentd',
-                         'scality-nasdk-tools')
+    install_packages(*node_packages())
 
-    nodeconf = run('which scality-node-config')  # Required for CentOS
+    nodeconf = which('scality-node-config')  # Required for CentOS
     sudo('{0:s} --resetconfig --preseed-file /tmp/preseed'.format(nodeconf))
 
     # Configure sagentd.
@@ -660,43 +1294,188 @@ def setup_node(supervisor_host, prefix='/scality/disk', metadisks=None,
         after='/var/lib/scality-sagentd/oidlist.txt',
         use_sudo=True,
     )
-    restart_service('scality-sagentd')
-    restart_service('snmpd')
+    with batch():
+        restart_service('scality-sagentd')
+        restart_service('snmpd')
 
-    # Create ring.
-    retries = 10
     setup_ringsh(ring, supervisor_host, env.host)
-    run('ringsh supervisor ringCreate {0:s}'.format(ring))
-    run('ringsh supervisor serverAdd {0:s} {1:s} 7084'.format(ring, env.host))
-    for retry in range(retries):
-        time.sleep(5)
-        cmd = run(
-            command='ringsh supervisor nodeSetRing '
-                    '{0:s} {1:s} 8084'.format(ring, env.host),
-            warn_only=True,
-        )
-        if cmd.succeeded:
-            break
-    else:
-        raise Exception("Unable to assign node to ring {0:s}".format(ring))
-    for retry in range(retries):
-        time.sleep(5)
-        cmd = run(
-            command='ringsh supervisor nodeJoin {0:s} 8084'.format(env.host),
-            warn_only=True,
+
+
+def join_nodes(supervisor_host, hosts, ring='MyRing'):
+    """
+    Create a ring, and join store nodes installed by :py:func:`install_node`
+    to it.
+
+    Each step is done for all nodes at once: servers are registered, then
+    assigned to the ring, then joined, and the nodes still failing a step
+    are retried together.  Calls go through ringsh on the current host,
+    whose ringsh must be configured for the supervisor, the calls of a step
+    in a single remote call, see :py:func:`_ringsh_batch`.
+
+    :param supervisor_host: hostname or ip of the supervisor
+    :type supervisor_host: string
+    :param hosts: hostnames or ips of the store nodes
+    :type hosts: list
+    :param ring: name of the ring
+    :type ring: string
+    """
+    # Ring and servers are already there when a deployment is resumed.
+    if not ring_exists(ring):
+        ringsh.ringsh('supervisor ringCreate {0:s}'.format(ring))
+    servers = listed_servers(ringsh.ringsh('supervisor serverList'))
+    _ringsh_batch(['supervisor serverAdd {0:s} {1:s} 7084'.format(ring, host)
+                   for host in hosts if host not in servers])
+
+    def set_rings(pending):
+        results = _ringsh_batch(
+            ['supervisor nodeSetRing {0:s} {1:s} 8084'.format(ring, host)
+             for host in pending],
+            warn_only=True)
+        return [host for host, result in zip(pending, results)
+                if result.failed]
+
+    def join(pending):
+        # Statuses are queried right after the joins, in the same call.
+        results = _ringsh_batch(
+            ['supervisor nodeJoin {0:s} 8084'.format(host)
+             for host in pending] +
+            ['supervisor nodeStatus {0:s} 8084'.format(host)
+             for host in pending],
+            warn_only=True)
+        joins, statuses = results[:len(pending)], results[len(pending):]
+        return [host for host, result, status in zip(pending, joins, statuses)
+                if result.failed or not status.strip().startswith('RUN')]
+
+    for step, description in ((set_rings, 'assigned to'),
+                              (join, 'joined to')):
+        pending = list(hosts)
+
+        def attempt():
+            pending[:] = step(pending)
+            return pending
+
+        waits.wait(
+            attempt,
+            'node(s) {0:s} {1:s} ring {2:s}'.format(
+                ', '.join(hosts), description, ring),
+            predicate=lambda remaining: not remaining,
         )
-        if cmd.succeeded:
-            # Ensure node status
-            cmd = run(
-                command='ringsh supervisor nodeStatus {ip:s} 8084'.format(
-                    ip=env.host
-                ),
-                warn_only=True,
-            )
-            if cmd.strip().startswith('RUN'):
-                break
-    else:
-        raise Exception("Unable join node to ring {0:s}".format(ring))
+
+
+def _ringsh_batch(commands, warn_only=False):
+    """
+    Run ringsh commands on the current host in a single remote call, see
+    :py:class:`Batch`.  Each command still runs in a ringsh process of its
+    own, which gives its exit status.
+
+    :param commands: list of commands, eg `supervisor nodeStatus ...`
+    :type commands: list
+    :param warn_only: whether failures of the commands are tolerated
+    :type warn_only: bool
+    :return: list of results, see :py:class:`CommandResult`
+    """
+    ringsh_path = which('ringsh')
+    with batch():
+        queued = [_sudo('{0:s} {1:s}'.format(ringsh_path, command),
+                        warn_only=warn_only)
+                  for command in commands]
+    return [command.result for command in queued]
+
+
+def ring_exists(ring):
+    """
+    Check whether a ring is known to the supervisor, from the current host.
+
+    :param ring: name of the ring
+    :type ring: string
+    :return: bool
+    """
+    return ringsh.ringsh('supervisor ringStatus {0:s}'.format(ring),
+                         warn_only=True).succeeded
+
+
+def supervisor_running():
+    """
+    Check whether the supervisor of the current host answers.
+
+    :return: bool
+    """
+    return ringsh.ringsh('supervisor serverList', warn_only=True).succeeded
+
+
+def node_running(supervisor_host):
+    """
+    Check whether the node of the current host runs in its ring.
+
+    :param supervisor_host: hostname or ip of the supervisor
+    :type supervisor_host: string
+    :return: bool
+    """
+    return nodes_running(supervisor_host, [env.host])
+
+
+def nodes_running(supervisor_host, hosts):
+    """
+    Check whether store nodes run in their ring, from the current host.
+
+    :param supervisor_host: hostname or ip of the supervisor
+    :type supervisor_host: string
+    :param hosts: hostnames or ips of the store nodes
+    :type hosts: list
+    :return: bool
+    """
+    statuses = _ringsh_batch(
+        ['supervisor nodeStatus {0:s} 8084'.format(host) for host in hosts],
+        warn_only=True)
+    return all(status.strip().startswith('RUN') for status in statuses)
+
+
+def node_installed():
+    """
+    Check whether the store node of the current host is installed and
+    runs, see :py:func:`install_node`.
+
+    :return: bool
+    """
+    return (packages_installed(*node_packages()) and
+            processes_running('bizstorenode'))
+
+
+def reset_nfs_connector():
+    """
+    Wipe the volume exported by the NFS connector, and the exports added
+    by scality-manila-utils, then restart the connector.
+    """
+    wipe_dir = '/tmp/manilaci-wipe'
+    sudo(
+        'mkdir -p {0:s} && mount -t nfs -o nolock 127.0.0.1:/ {0:s} && {{ '
+        'find {0:s} -mindepth 1 -delete; rc=$?; umount {0:s}; exit $rc; '
+        '}}'.format(wipe_dir)
+    )
+    put(abspath('assets/connector/etc/exports.conf'), '/etc/', use_sudo=True)
+    restart_service('scality-sfused')
+
+
+def reset_cifs_connector():
+    """
+    Wipe the volume of the CIFS connector, and the shares added by
+    scality-manila-utils, then restart the connector.
+    """
+    # The volume is mounted by sfused, at the mount point of its
+    # configuration, /ring/0 by default.
+    mount_point = sudo(
+        "sed -n 's/.*\"mountpoint\": *\"\\([^\"]*\\)\".*/\\1/p' "
+        "/etc/sfused.conf"
+    ).strip() or '/ring/0'
+
+    sudo('/etc/init.d/sernet-samba-smbd stop', warn_only=True)
+    with batch():
+        _sudo('for share in $(net conf listshares); do '
+              'net conf delshare $share; done')
+        _sudo('find {0:s} -mindepth 1 -delete'.format(mount_point))
+        restart_service('scality-sfused')
+    # See setup_cifs_connector.
+    sudo('/etc/init.d/sernet-samba-smbd start && sleep 5')
 
 
 def install_scality_manila_utils():
@@ -722,22 +1501,23 @@ def setup_tunnel(name, local_ip, remote_ip, remote_net, gw_ip):
     :param gw_ip: local gw to remote network
     :type gw_ip: string
     """
-    sudo(
-        'ip tunnel add {name:s} mode gre remote {remote:s} local '
-        '{local:s} ttl 255'.format(
-            name=name,
-            remote=remote_ip,
-            local=local_ip
+    with batch():
+        _sudo(
+            'ip tunnel add {name:s} mode gre remote {remote:s} local '
+            '{local:s} ttl 255'.format(
+                name=name,
+                remote=remote_ip,
+                local=local_ip
+            )
         )
-    )
-    sudo('ip link set {name:s} up'.format(name=name))
-    sudo('ip addr add {gw_ip:s}/24 dev {name:s}'.format(
-            gw_ip=gw_ip,
-            name=name,
+        _sudo('ip link set {name:s} up'.format(name=name))
+        _sudo('ip addr add {gw_ip:s}/24 dev {name:s}'.format(
+                gw_ip=gw_ip,
+                name=name,
+            )
         )
-    )
-    sudo('ip route add {remote_net:s} dev {name:s}'.format(
-            remote_net=remote_net,
-            name=name,
+        _sudo('ip route add {remote_net:s} dev {name:s}'.format(
+                remote_net=remote_net,
+                name=name,
+            )
         )
-    )
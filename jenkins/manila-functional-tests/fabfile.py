@@ -1,65 +1,195 @@
+import copy
 import datetime
 import io
 import json
 import os
+import subprocess
 
 import bootstrap
 import heat
+import leases
+import stages
 
-from fabric.api import env, execute, parallel, roles, task
+from fabric.api import (abort, env, execute, parallel, roles, settings,
+                        task)
+from fabric.network import disconnect_all
 
 
-def deploy_infrastructure(public_key, image):
+# Record of the deployment stack id, of its own for each Jenkins build so
+# that a build never acts on the deployment of another one.
+DEPLOYMENT_PATH = '/tmp/manilaci-deployment' + (
+    '-' + os.environ['BUILD_TAG'] if os.environ.get('BUILD_TAG') else '')
+
+# Journal of the deployment stages done, see `resume`.
+JOURNAL_PATH = DEPLOYMENT_PATH + '.journal'
+
+# Host addresses for the next CI steps, see `write_hosts`.
+HOSTS_PATH = '/tmp/manilaci-hosts'
+
+TEMPLATE_FILE = 'manila-ci.yaml'
+
+RING_RELEASE = 'stable_lorien'
+
+# Age after which a leased deployment is replaced (seconds), see `lease`.
+LEASE_MAX_AGE = 24 * 3600
+
+# Heat server resources of the deployment, with the role and the output
+# holding the address of each.  They are the first server of their role,
+# further servers are copies, see `_scale_template`.
+SERVERS = (
+    ('ring', 'ring', 'ring_ip'),
+    ('nfs-connector', 'nfs_connector', 'nfs_ip'),
+    ('cifs-connector', 'cifs_connector', 'cifs_ip'),
+)
+
+
+def _heat_client():
+    return heat.client_session(
+        auth_url=os.environ['OS_AUTH_URL'],
+        tenant=os.environ['OS_TENANT_NAME'],
+        username=os.environ['OS_USERNAME'],
+        password=os.environ['OS_PASSWORD'],
+    )
+
+
+def _as_bool(value):
+    return value in (True, 'yes', 'true', 'True', '1')
+
+
+def _topology(nodes=1, nfs_connectors=1, cifs_connectors=1):
+    """
+    Get the number of servers of each role of a deployment.
+
+    :param nodes: number of storage nodes, the first one running the
+        supervisor
+    :type nodes: int
+    :param nfs_connectors: number of NFS connectors
+    :type nfs_connectors: int
+    :param cifs_connectors: number of CIFS connectors
+    :type cifs_connectors: int
+    :return: dict of server counts by role
+    """
+    topology = {
+        'ring': int(nodes),
+        'nfs_connector': int(nfs_connectors),
+        'cifs_connector': int(cifs_connectors),
+    }
+    if min(topology.values()) < 1:
+        raise ValueError('At least one server of each role is needed')
+    return topology
+
+
+def _servers(topology):
     """
-    Deploy infrastructure backing ring and connectors.
+    Get the servers of a deployment.
 
-    Three hosts will be deployed:
-     - ring: for the purpose of hosting a single node ring and supervisor
-     - nfs_connector: for the purpose of running sfused + nfs
-     - cifs_connector: for the purpose of running sfused + samba
+    :param topology: server counts by role, see `_topology`
+    :type topology: dict
+    :return: list of tuples of the member name (role, then role-2...),
+        heat resource and role of each server
+    """
+    servers = []
+    for resource, role, _ in SERVERS:
+        servers.append((role, resource, role))
+        for index in range(2, topology[role] + 1):
+            suffix = '-{0:d}'.format(index)
+            servers.append((role + suffix, resource + suffix, role))
+    return servers
+
+
+def _scale_template(topology):
+    """
+    Make the transform of the heat template for a topology: the server
+    resources beyond the first of each role are copies of the first one.
+
+    :param topology: server counts by role, see `_topology`
+    :type topology: dict
+    :return: function, see :py:func:`heat.create`
+    """
+    def transform(template):
+        for resource, role, output in SERVERS:
+            for index in range(2, topology[role] + 1):
+                suffix = '-{0:d}'.format(index)
+                server = copy.deepcopy(template['resources'][resource])
+                server['properties']['name']['str_replace']['template'] += \
+                    suffix
+                template['resources'][resource + suffix] = server
+                template['outputs']['{0:s}_{1:d}'.format(output, index)] = {
+                    'description': 'IP of {0:s}'.format(resource + suffix),
+                    'value': {'get_attr': [resource + suffix,
+                                           'first_address']},
+                }
+        return template
+    return transform
+
+
+def create_infrastructure(heat_client, public_key, image, topology=None,
+                          record=True):
+    """
+    Request the creation of the infrastructure, and record its stack id.
 
+    :param heat_client: heat client
+    :type heat_client: :py:class:`heatclient.client.Client`
     :param public_key: public key for infrastructure authentication
     :type public_key: string
     :param image: glance image to boot from
     :type image: string
+    :param topology: server counts by role, see `_topology` (optional)
+    :type topology: dict
+    :param record: whether to record the stack id as the deployment of
+        this run
+    :type record: bool
+    :return: stack id
     """
-    heat_client = heat.client_session(
-        auth_url=os.environ['OS_AUTH_URL'],
-        tenant=os.environ['OS_TENANT_NAME'],
-        username=os.environ['OS_USERNAME'],
-        password=os.environ['OS_PASSWORD'],
-    )
-    template_file = 'manila-ci.yaml'
+    topology = topology or _topology()
     timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S')
     deployment_name = 'ManilaCI_{0:s}'.format(timestamp)
-    stack = heat.deploy(
+    stack_id = heat.create(
         name=deployment_name,
-        template_file=template_file,
+        template_file=TEMPLATE_FILE,
         heat_client=heat_client,
+        transform=_scale_template(topology),
         public_key=public_key,
         deployment_name=deployment_name,
         image=image,
     )
 
-    # Record deployment stack id.
-    print('Initiated Manila CI deployment: {0:s}'.format(stack.id))
-    with io.open('/tmp/manilaci-deployment', 'wb') as f:
-        json.dump({'stack_id': stack.id}, f, indent=2)
+    print('Initiated Manila CI deployment: {0:s}'.format(stack_id))
+    if record:
+        _record_deployment(stack_id, topology)
 
-    hosts = {}
-    for out in stack.outputs:
-        hosts[out['output_key']] = out['output_value']
+    return stack_id
 
-    for host in ('ring_ip', 'nfs_ip', 'cifs_ip'):
-        if host not in hosts:
-            raise Exception("Expected '{0:s}' in deployment".format(host))
 
-    return hosts
+def _record_deployment(stack_id, topology, lease=False):
+    with io.open(DEPLOYMENT_PATH, 'wb') as f:
+        json.dump({'stack_id': stack_id, 'topology': topology,
+                   'lease': lease}, f, indent=2)
+
+
+def _recorded_deployment():
+    try:
+        with io.open(DEPLOYMENT_PATH, 'rb') as f:
+            return json.load(f)
+    except IOError:
+        abort('No deployment recorded in {0:s}'.format(DEPLOYMENT_PATH))
+
+
+def _forget_deployment():
+    """
+    Remove the record and the journal of the last deployment, so that a run
+    failing before recording its own deployment does not act on that one.
+    """
+    try:
+        os.remove(DEPLOYMENT_PATH)
+    except OSError:
+        pass
+    stages.Journal(JOURNAL_PATH).reset()
 
 
 @roles('ring', 'nfs_connector', 'cifs_connector')
 @parallel
-def prepare_host(repo_credentials):
+def prepare_host(repo_credentials, package_proxy=None):
     """
     Carry out initial host perparation tasks.
 
@@ -69,83 +199,372 @@ def prepare_host(repo_credentials):
 
     :param credentials: credentials for packages.scality.com
     :type credentials: string
+    :param package_proxy: URL of an HTTP proxy for package downloads
+        (optional)
+    :type package_proxy: string
     """
     bootstrap.initial_host_config()
-    bootstrap.add_package_repositories(repo_credentials)
+    bootstrap.add_package_repositories(repo_credentials, RING_RELEASE,
+                                       proxy=package_proxy)
 
 
 @roles('ring')
-def setup_ring():
+def setup_supervisor():
     """
-    Install a ring together with supervisor on the same host.
+    Install the supervisor.
     """
-    # Bootstrap supervisor
-    supervisor_host = env.host
     bootstrap.setup_supervisor()
 
-    # Bootstrap ring
-    bootstrap.fake_disk()
+
+@roles('ring')
+def setup_disks(quantity=1, size=40):
+    """
+    Setup the disks of the ring node.
+
+    :param quantity: number of disks
+    :type quantity: int
+    :param size: size of each disk (GB)
+    :type size: int
+    """
+    bootstrap.fake_disk(quantity=int(quantity), size=int(size))
+
+
+@roles('ring')
+def setup_storage_node(supervisor_host):
+    """
+    Install a storage node and bootstrap the ring with it.
+
+    :param supervisor_host: host where the supervisor is running
+    :type supervisor_host: string
+    """
     bootstrap.setup_node(supervisor_host)
 
 
+@roles('ring')
+@parallel
+def install_storage_node(supervisor_host):
+    """
+    Install a storage node, to be joined by `join_storage_nodes`.
+
+    :param supervisor_host: host where the supervisor is running
+    :type supervisor_host: string
+    """
+    bootstrap.install_node(supervisor_host)
+
+
+def join_storage_nodes(supervisor_host, *hosts):
+    """
+    Bootstrap the ring with storage nodes, from the supervisor host.
+
+    :param supervisor_host: host where the supervisor is running
+    :type supervisor_host: string
+    :param hosts: hosts of the storage nodes
+    :type hosts: argument list of strings
+    """
+    bootstrap.join_nodes(supervisor_host, list(hosts))
+
+
+@roles('ring')
+def install_ring_packages(supervisor=True):
+    """
+    Install the packages of the supervisor and storage node ahead of their
+    setup, in a single transaction.
+
+    :param supervisor: whether the host runs the supervisor, or only a
+        storage node
+    :type supervisor: bool
+    """
+    bootstrap.put_installation_credentials()
+    with bootstrap.package_transaction():
+        bootstrap.install_packages(*_ring_packages(supervisor))
+
+
+def _ring_packages(supervisor):
+    if _as_bool(supervisor):
+        return bootstrap.ring_packages()
+    return bootstrap.node_packages()
+
+
+def install_connector_packages(role):
+    """
+    Install the packages of a connector ahead of its setup, in a single
+    transaction.
+
+    :param role: connector role (nfs, cifs, localfs, or dewpoint)
+    :type role: string
+    """
+    with bootstrap.package_transaction():
+        bootstrap.install_packages(*bootstrap.connector_packages(role))
+
+
+def _connector_name(protocol, index):
+    # As server names, the first connector of a protocol has no suffix.
+    index = int(index)
+    if index == 1:
+        return protocol
+    return '{0:s}-{1:d}'.format(protocol, index)
+
+
 @roles('nfs_connector')
-def setup_nfs_connector(supervisor_host):
+def setup_nfs_connector(supervisor_host, index=1):
     """
     Setup and configure the NFS connector with scality-manila-utils.
 
     :param supervisor_host: host where the supervisor is running
     :type supervisor_host: string
+    :param index: index of the connector among the NFS connectors, from 1,
+        which makes its name unique at the supervisor
+    :type index: int
     """
-    bootstrap.setup_nfs_connector('manila_nfs', 1, supervisor_host)
+    bootstrap.setup_nfs_connector('manila_nfs', 1, supervisor_host,
+                                  name=_connector_name('nfs', index))
     bootstrap.install_scality_manila_utils()
 
 
 @roles('cifs_connector')
-def setup_cifs_connector(supervisor_host):
+def setup_cifs_connector(supervisor_host, index=1):
     """
     Setup and configure the CIFS connector with scality-manila-utils.
 
     :param supervisor_host: host where the supervisor is running
     :type supervisor_host: string
+    :param index: index of the connector among the CIFS connectors, from 1,
+        which makes its name unique at the supervisor
+    :type index: int
     """
-    bootstrap.setup_cifs_connector('manila_cifs', 2, supervisor_host)
+    bootstrap.setup_cifs_connector('manila_cifs', 2, supervisor_host,
+                                   name=_connector_name('cifs', index))
     bootstrap.install_scality_manila_utils()
 
 
-@task
-def deploy(public_key, image="Ubuntu 14.04 amd64"):
+def _on_host(host_task, host, *args):
     """
-    Deploy a single node ring with nfs and cifs connector.
+    Run a fabric task on a single host, from a deployment stage.
+    """
+    execute(host_task, *args, hosts=[host])
 
-    Setup the infrastructure and configure required packages for integration
-    with the Scality Manila Driver.
 
-    The following environment variables must be set:
-     - OS_AUTH_URL
-     - OS_TENANT_NAME
-     - OS_USERNAME
-     - OS_PASSWORD
+class CheckAborted(Exception):
+    """
+    Raised instead of exiting when fabric aborts during a stage check.
+    """
 
-    :param public_key: public key for infrastructure authentication
-    :type public_key: string
-    :param image: glance image to boot from
-    :type image: string
+
+def _checked_on_host(check):
+    """
+    Make the check of an `_on_host` stage, running the `check` task with
+    the arguments of the stage task, on the host of the stage.
+    """
+    def check_stage(host_task, host, *args):
+        try:
+            with settings(abort_exception=CheckAborted):
+                return execute(check, *args, hosts=[host])[host]
+        except Exception:
+            # An unreachable host or a failing command fails the check.
+            return False
+    return check_stage
+
+
+def _check_ring_packages(supervisor=True):
+    return bootstrap.packages_installed(*_ring_packages(supervisor))
+
+
+def _check_connector_packages(role):
+    return bootstrap.packages_installed(*bootstrap.connector_packages(role))
+
+
+def _check_supervisor():
+    return bootstrap.supervisor_running()
+
+
+def _check_disks():
+    return bootstrap.disks_healthy()
+
+
+def _check_storage_node(supervisor_host):
+    return bootstrap.node_installed()
+
+
+def _check_ring(supervisor_host, *hosts):
+    return bootstrap.nodes_running(supervisor_host, list(hosts))
+
+
+def _check_nfs_connector(supervisor_host, index=1):
+    return bootstrap.processes_running('sfused')
+
+
+def _check_cifs_connector(supervisor_host, index=1):
+    return bootstrap.processes_running('sfused', 'smbd')
+
+
+def _wait_for_stack(stack_id):
+    stack, creation_times = heat.wait_for_stack(_heat_client(), stack_id)
+    heat.print_creation_times(creation_times)
+
+
+def _wait_for_server(stack_id, resource):
     """
-    hosts = deploy_infrastructure(public_key, image)
-    env.roledefs = {
-        'ring': [hosts['ring_ip']],
-        'nfs_connector': [hosts['nfs_ip']],
-        'cifs_connector': [hosts['cifs_ip']],
+    Wait for a server of the deployment to be reachable over ssh.
+
+    :return: address of the server
+    """
+    server = heat.wait_for_resource(_heat_client(), stack_id, resource)
+    host = server.attributes['first_address']
+    bootstrap.wait_for_ssh(host)
+    return host
+
+
+def _role_hosts(topology, addresses):
+    hosts = dict((role, []) for role in topology)
+    for (_, _, role), address in zip(_servers(topology), addresses):
+        hosts[role].append(address)
+    return hosts
+
+
+def _write_hosts(topology, *addresses):
+    hosts = _role_hosts(topology, addresses)
+    write_hosts(hosts)
+    return hosts
+
+
+def _hosts_written(topology, *addresses):
+    try:
+        written = read_hosts()
+    except IOError:
+        return False
+    return all(written.get(role.upper() + '_HOSTS') == hosts
+               for role, hosts in _role_hosts(topology, addresses).items())
+
+
+def deployment_plan(stack_id, repo_credentials, streaming=True,
+                    package_proxy=None, record_hosts=True, topology=None):
+    """
+    Declare the stages of a deployment, and their dependencies.
+
+    Each host is prepared as soon as it answers on ssh, then all the
+    packages it needs are installed at once.  Disks and supervisor are set
+    up concurrently on the first ring host, while the other storage nodes
+    and connector packages get installed.  All storage nodes are joined to
+    the ring together, from the supervisor host.  The connectors are then
+    set up concurrently once the ring is up.
+
+    When streaming, the stack is still watched alongside, so that a failed
+    stack fails the plan at once rather than through server timeouts.
+
+    :param stack_id: id of the deployment stack
+    :type stack_id: string
+    :param repo_credentials: credentials for packages.scality.com
+    :type repo_credentials: string
+    :param streaming: whether to set up each host as soon as it is booted,
+        instead of waiting for the whole stack
+    :type streaming: bool
+    :param package_proxy: URL of an HTTP proxy for package downloads
+        (optional)
+    :type package_proxy: string
+    :param record_hosts: whether to write host addresses for the next CI
+        steps, see `write_hosts`
+    :type record_hosts: bool
+    :param topology: server counts by role, see `_topology` (optional)
+    :type topology: dict
+    :return: :py:class:`stages.Scheduler`
+    """
+    topology = topology or _topology()
+    servers = _servers(topology)
+    plan = stages.Scheduler()
+    plan.add('infrastructure', _wait_for_stack, stack_id)
+    boot_requires = [] if streaming else ['infrastructure']
+
+    for member, resource, _ in servers:
+        plan.add('boot:' + member, _wait_for_server, stack_id, resource,
+                 requires=boot_requires, interruptible=True)
+        # Repositories are trusted to still be set up.
+        plan.add('prepare:' + member, _on_host, prepare_host,
+                 plan.result('boot:' + member), repo_credentials,
+                 package_proxy, requires=['boot:' + member])
+
+    if record_hosts:
+        plan.add('hosts', _write_hosts, topology,
+                 *[plan.result('boot:' + member) for member, _, _ in servers],
+                 requires=['boot:' + member for member, _, _ in servers],
+                 check=_hosts_written)
+
+    ring = plan.result('boot:ring')
+    nodes = [member for member, _, role in servers if role == 'ring']
+    for member in nodes:
+        host = plan.result('boot:' + member)
+        plan.add('packages:' + member, _on_host, install_ring_packages,
+                 host, member == 'ring', requires=['prepare:' + member],
+                 check=_checked_on_host(_check_ring_packages))
+        plan.add('disks:' + member, _on_host, setup_disks, host,
+                 requires=['prepare:' + member],
+                 check=_checked_on_host(_check_disks))
+
+    plan.add('supervisor', _on_host, setup_supervisor, ring,
+             requires=['packages:ring'],
+             check=_checked_on_host(_check_supervisor))
+    for member in nodes:
+        # The supervisor and the node of its host both configure ringsh.
+        plan.add('node:' + member, _on_host, install_storage_node,
+                 plan.result('boot:' + member), ring,
+                 requires=['packages:' + member, 'disks:' + member] +
+                 (['supervisor'] if member == 'ring' else []),
+                 check=_checked_on_host(_check_storage_node))
+    plan.add('ring', _on_host, join_storage_nodes, ring, ring,
+             *[plan.result('boot:' + member) for member in nodes],
+             requires=['supervisor'] + ['node:' + member for member in nodes],
+             check=_checked_on_host(_check_ring))
+
+    connectors = {
+        'nfs_connector': ('nfs', setup_nfs_connector, _check_nfs_connector),
+        'cifs_connector': ('cifs', setup_cifs_connector,
+                           _check_cifs_connector),
     }
+    for member, _, role in servers:
+        if role not in connectors:
+            continue
+        protocol, setup_task, check = connectors[role]
+        host = plan.result('boot:' + member)
+        index = [name for name, _, server_role in servers
+                 if server_role == role].index(member) + 1
+        plan.add('packages:' + member, _on_host, install_connector_packages,
+                 host, protocol, requires=['prepare:' + member],
+                 check=_checked_on_host(_check_connector_packages))
+        plan.add(member, _on_host, setup_task, host, ring, index,
+                 requires=['packages:' + member, 'ring'],
+                 check=_checked_on_host(check))
+
+    return plan
+
+
+def write_hosts(hosts):
+    """
+    Write instance IPs to file.
+
+    The scality-manila-devstack-plugin relies on this information.  The
+    first host of each role is the one used by later CI steps, lists of
+    all hosts are written as well.
+
+    :param hosts: dict of lists of host addresses by role
+    :type hosts: dict
+    """
+    env.roledefs = dict(hosts)
 
-    # Write instance IPs to file.
-    # The scality-manila-devstack-plugin relies on this information.
-    infra_dumpfile = '/tmp/manilaci-hosts'
+    infra_dumpfile = HOSTS_PATH
     export_lines = u'''
         export NFS_CONNECTOR_HOST={nfs_ip:s}
         export CIFS_CONNECTOR_HOST={cifs_ip:s}
         export RING_HOST={ring_ip:s}
-    '''.format(**hosts)
+        export NFS_CONNECTOR_HOSTS="{nfs_ips:s}"
+        export CIFS_CONNECTOR_HOSTS="{cifs_ips:s}"
+        export RING_HOSTS="{ring_ips:s}"
+    '''.format(
+        nfs_ip=hosts['nfs_connector'][0],
+        cifs_ip=hosts['cifs_connector'][0],
+        ring_ip=hosts['ring'][0],
+        nfs_ips=' '.join(hosts['nfs_connector']),
+        cifs_ips=' '.join(hosts['cifs_connector']),
+        ring_ips=' '.join(hosts['ring']),
+    )
 
     with io.open(infra_dumpfile, 'w') as f:
         f.write(export_lines)
@@ -156,10 +575,309 @@ def deploy(public_key, image="Ubuntu 14.04 amd64"):
         )
     )
 
-    execute(prepare_host, os.environ['SCAL_PASS'])
-    execute(setup_ring)
-    execute(setup_nfs_connector, hosts['ring_ip'])
-    execute(setup_cifs_connector, hosts['ring_ip'])
+
+def read_hosts():
+    """
+    Read the instance IPs written by :py:func:`write_hosts`.
+
+    :return: dict of lists of host addresses by exported variable name
+    """
+    hosts = {}
+    with io.open(HOSTS_PATH, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line.startswith('export '):
+                continue
+            name, _, value = line[len('export '):].partition('=')
+            hosts[name] = value.strip('"').split()
+    return hosts
+
+
+@task
+def deploy(public_key, image="Ubuntu 14.04 amd64", streaming=False,
+           nodes=1, nfs_connectors=1, cifs_connectors=1):
+    """
+    Deploy a ring with nfs and cifs connectors, by default a single node
+    ring with one connector of each.
+
+    Setup the infrastructure and configure required packages for integration
+    with the Scality Manila Driver.  Deployment stages run concurrently
+    where possible, see `deployment_plan`.
+
+    The following environment variables must be set:
+     - OS_AUTH_URL
+     - OS_TENANT_NAME
+     - OS_USERNAME
+     - OS_PASSWORD
+     - SCAL_PASS
+
+    Package downloads from packages.scality.com, and from the hosts of
+    PACKAGE_PROXY_HOSTS, go through the HTTP proxy at PACKAGE_PROXY if
+    set, such as the caching proxy of `pkgcache.py`.
+
+    :param public_key: public key for infrastructure authentication
+    :type public_key: string
+    :param image: glance image to boot from
+    :type image: string
+    :param streaming: whether to set up each host as soon as it is booted,
+        instead of waiting for the whole infrastructure
+    :type streaming: bool
+    :param nodes: number of storage nodes, the first one running the
+        supervisor
+    :type nodes: int
+    :param nfs_connectors: number of NFS connectors, all exporting the
+        same volume
+    :type nfs_connectors: int
+    :param cifs_connectors: number of CIFS connectors, all exporting the
+        same volume
+    :type cifs_connectors: int
+    """
+    _forget_deployment()
+    topology = _topology(nodes, nfs_connectors, cifs_connectors)
+    journal = stages.Journal(JOURNAL_PATH)
+    stack_id = create_infrastructure(_heat_client(), public_key, image,
+                                     topology)
+    bootstrap.use_deployment_facts(stack_id)
+    plan = deployment_plan(stack_id, os.environ['SCAL_PASS'],
+                           _as_bool(streaming),
+                           os.environ.get('PACKAGE_PROXY'),
+                           topology=topology)
+    plan.run(on_done=journal.record)
+
+
+@task
+def resume(stack_id=None):
+    """
+    Resume a deployment which failed, on its existing stack.
+
+    Stages recorded as done in the journal of the deployment are checked,
+    and only the stages no longer done, or never done, are run.
+
+    The same environment variables as for `deploy` must be set.
+
+    :param stack_id: the stack id of the deployment to resume (optional)
+        if it is not given, it is assumed to be found under
+        `DEPLOYMENT_PATH`, otherwise the deployment is assumed to
+        have the default topology
+    :type stack_id: string
+    """
+    journal_path = JOURNAL_PATH
+    topology = None
+    if stack_id is None:
+        deployment = _recorded_deployment()
+        stack_id = deployment['stack_id']
+        topology = deployment.get('topology')
+        if deployment.get('lease'):
+            journal_path = leases.LeaseStore().journal_path(stack_id)
+
+    bootstrap.use_deployment_facts(stack_id)
+    # Package operations recorded by the failed run may not have completed.
+    bootstrap.clear_facts()
+    _resume(stack_id, stages.Journal(journal_path), topology)
+
+
+def _resume(stack_id, journal, topology=None, record_hosts=True):
+    """
+    Run the stages of a deployment not done yet according to its journal.
+
+    :return: dict of stage results by stage name
+    """
+    plan = deployment_plan(stack_id, os.environ['SCAL_PASS'],
+                           package_proxy=os.environ.get('PACKAGE_PROXY'),
+                           record_hosts=record_hosts, topology=topology)
+    done = plan.verify(journal.load())
+    # Stage processes must not share the connections opened by checks.
+    disconnect_all()
+    return plan.run(skip=done, on_done=journal.record)
+
+
+def _stack_complete(heat_client, stack_id):
+    try:
+        stack = heat_client.stacks.get(stack_id)
+    except Exception:
+        return False
+    return stack.stack_status in ('CREATE_COMPLETE', 'UPDATE_COMPLETE')
+
+
+def _spawn(task_call):
+    """
+    Run a fabric task in the background, with the connection options of
+    this run.  Its output goes to /tmp/manilaci-lease-build.log.
+
+    The task outlives the CI job: Jenkins does not kill it along with the
+    processes of the job, and it downloads packages without the package
+    proxy, which the job stops at teardown.
+    """
+    command = ['fab', '-f', env.real_fabfile, task_call,
+               '--connection-attempts', str(env.connection_attempts)]
+    if env.user:
+        command += ['-u', env.user]
+    key_filenames = env.key_filename or []
+    if isinstance(key_filenames, basestring):
+        key_filenames = [key_filenames]
+    for key_filename in key_filenames:
+        command += ['-i', key_filename]
+
+    # Jenkins kills the processes whose environment holds the BUILD_ID or
+    # JENKINS_NODE_COOKIE of the job.
+    task_env = dict(os.environ, BUILD_ID='dontKillMe',
+                    JENKINS_NODE_COOKIE='dontKillMe')
+    task_env.pop('PACKAGE_PROXY', None)
+    with io.open('/tmp/manilaci-lease-build.log', 'ab') as log:
+        subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT,
+                         close_fds=True, preexec_fn=os.setsid, env=task_env)
+    print('Started in the background: {0:s}'.format(task_call))
+
+
+def _replace_lease(store, heat_client, stack_id, public_key, image,
+                   topology):
+    """
+    Delete the stack of a lease, and build a replacement in the background.
+    """
+    print('Replacing leased deployment {0:s}'.format(stack_id))
+    try:
+        heat_client.stacks.delete(stack_id)
+    except Exception as e:
+        print('Unable to delete stack {0:s}: {1!s}'.format(stack_id, e))
+    store.remove(stack_id)
+    bootstrap.clear_facts(stack_id)
+    _spawn('lease_build:{0:s},{1:s},{2:d},{3:d},{4:d}'.format(
+        _escape_argument(public_key), _escape_argument(image),
+        topology['ring'], topology['nfs_connector'],
+        topology['cifs_connector']))
+
+
+def _escape_argument(value):
+    # Fabric splits task arguments on unescaped commas.
+    return value.replace(',', r'\,')
+
+
+@task
+def lease(public_key, image="Ubuntu 14.04 amd64", max_age=LEASE_MAX_AGE,
+          nodes=1, nfs_connectors=1, cifs_connectors=1):
+    """
+    Claim a deployment kept from an earlier run, instead of deploying one.
+
+    Leased deployments are kept on this host by key: heat template hash,
+    image, RING release and topology.  The newest healthy one is claimed,
+    its stages checked as by `resume`, and its data plane reset: the
+    manila_nfs and manila_cifs volumes are wiped and the connectors
+    restarted.  Leases older than `max_age`, or whose stack is not
+    complete, are replaced by deployments built in the background, as are
+    builds not done within `leases.BUILD_TIMEOUT`, such as builds killed
+    along with their CI job.  If no lease is available, a deployment is
+    done, and kept for later runs by `release`.
+
+    The management key must be the same for all runs, and the same
+    environment variables as for `deploy` must be set.
+
+    :param public_key: public key for infrastructure authentication
+    :type public_key: string
+    :param image: glance image to boot from
+    :type image: string
+    :param max_age: age after which a lease is replaced (seconds)
+    :type max_age: int
+    :param nodes: number of storage nodes, see `deploy`
+    :type nodes: int
+    :param nfs_connectors: number of NFS connectors
+    :type nfs_connectors: int
+    :param cifs_connectors: number of CIFS connectors
+    :type cifs_connectors: int
+    """
+    _forget_deployment()
+    max_age = int(max_age)
+    topology = _topology(nodes, nfs_connectors, cifs_connectors)
+    heat_client = _heat_client()
+    store = leases.LeaseStore()
+    key = leases.lease_key(TEMPLATE_FILE, image, RING_RELEASE, topology)
+
+    for stack_id in store.expired(key, max_age):
+        _replace_lease(store, heat_client, stack_id, public_key, image,
+                       topology)
+
+    while True:
+        stack_id = store.claim(key, max_age)
+        if stack_id is None or _stack_complete(heat_client, stack_id):
+            break
+        _replace_lease(store, heat_client, stack_id, public_key, image,
+                       topology)
+
+    reused = stack_id is not None
+    if reused:
+        print('Claimed leased deployment {0:s}'.format(stack_id))
+    else:
+        stack_id = create_infrastructure(heat_client, public_key, image,
+                                         topology, record=False)
+        store.add(stack_id, key)
+        store.set_state(stack_id, leases.CLAIMED)
+    _record_deployment(stack_id, topology, lease=True)
+    bootstrap.use_deployment_facts(stack_id)
+    bootstrap.clear_facts()
+
+    results = _resume(stack_id, stages.Journal(store.journal_path(stack_id)),
+                      topology)
+    if reused:
+        for role, reset_task in (
+                ('nfs_connector', bootstrap.reset_nfs_connector),
+                ('cifs_connector', bootstrap.reset_cifs_connector)):
+            execute(reset_task, hosts=[
+                results['boot:' + member]
+                for member, _, server_role in _servers(topology)
+                if server_role == role])
+
+
+@task
+def lease_build(public_key, image="Ubuntu 14.04 amd64", nodes=1,
+                nfs_connectors=1, cifs_connectors=1):
+    """
+    Deploy for a lease, to be claimed by a later run, see `lease`.
+
+    :param public_key: public key for infrastructure authentication
+    :type public_key: string
+    :param image: glance image to boot from
+    :type image: string
+    :param nodes: number of storage nodes, see `deploy`
+    :type nodes: int
+    :param nfs_connectors: number of NFS connectors
+    :type nfs_connectors: int
+    :param cifs_connectors: number of CIFS connectors
+    :type cifs_connectors: int
+    """
+    topology = _topology(nodes, nfs_connectors, cifs_connectors)
+    heat_client = _heat_client()
+    store = leases.LeaseStore()
+    stack_id = create_infrastructure(heat_client, public_key, image,
+                                     topology, record=False)
+    store.add(stack_id, leases.lease_key(TEMPLATE_FILE, image, RING_RELEASE,
+                                         topology))
+    bootstrap.use_deployment_facts(stack_id)
+    plan = deployment_plan(stack_id, os.environ['SCAL_PASS'],
+                           package_proxy=os.environ.get('PACKAGE_PROXY'),
+                           record_hosts=False, topology=topology)
+    try:
+        plan.run(on_done=stages.Journal(store.journal_path(stack_id)).record)
+    except BaseException:
+        heat_client.stacks.delete(stack_id)
+        store.remove(stack_id)
+        bootstrap.clear_facts()
+        raise
+    store.set_state(stack_id, leases.READY)
+
+
+@task
+def release():
+    """
+    End the use of the deployment of this run: a leased deployment is kept
+    for later runs, any other deployment is destroyed.
+
+    The same environment variables as for `destroy` must be set.
+    """
+    deployment = _recorded_deployment()
+    if not deployment.get('lease'):
+        destroy(deployment['stack_id'])
+        return
+    leases.LeaseStore().set_state(deployment['stack_id'], leases.READY)
+    print('Released leased deployment {0:s}'.format(deployment['stack_id']))
 
 
 @task
@@ -245,18 +963,14 @@ def destroy(stack_id=None):
 
     :param stack_id: the stack id of the deployment to remove (optional)
         if it is not given, it is assumed to be found under
-        /tmp/manilaci-deployment
+        `DEPLOYMENT_PATH`
     :type stack_id: string
     """
     if stack_id is None:
-        with io.open('/tmp/manilaci-deployment', 'rb') as f:
-            deployment = json.load(f)
-            stack_id = deployment['stack_id']
+        stack_id = _recorded_deployment()['stack_id']
 
-    heat_client = heat.client_session(
-        auth_url=os.environ['OS_AUTH_URL'],
-        tenant=os.environ['OS_TENANT_NAME'],
-        username=os.environ['OS_USERNAME'],
-        password=os.environ['OS_PASSWORD'],
-    )
+    heat_client = _heat_client()
     heat_client.stacks.delete(stack_id)
+    # A leased deployment which failed is not kept.
+    leases.LeaseStore().remove(stack_id)
+    bootstrap.clear_facts(stack_id)
@@ -1,17 +1,31 @@
 
+import datetime
+import os
 import time
 
 import heatclient.client
-import keystoneclient.auth.identity.v2
 import keystoneclient.session
 
 from heatclient.common import template_utils
 
+# Shared with jobtool: keystone_cache.py links to utils/jobtool.
+import keystone_cache
+
+# Keystone tokens of the CI jobs, kept apart from those of jobtool.
+KEYSTONE_CACHE_DIR = os.path.expanduser('~/.cache/manilaci/keystone')
+
+# Heat clients of this process, by auth url, tenant, user and region.
+_clients = {}
+
 
 def client_session(auth_url, tenant, username, password, region=None):
     """
     Setup a keystone authenticated heat client session.
 
+    Keystone tokens are cached on disk and shared with other processes (see
+    :py:class:`keystone_cache.CachedPassword`), and clients are reused
+    within the process.
+
     :param auth_url: keystone authentication endpoint (v2)
     :type auth_url: string
     :param tenant: tenant name for authentication
@@ -24,7 +38,12 @@ def client_session(auth_url, tenant, username, password, region=None):
     :string region: string
     :return: :py:class:`heatclient.client.Client`
     """
-    auth = keystoneclient.auth.identity.v2.Password(
+    key = (auth_url, tenant, username, region)
+    if key in _clients:
+        return _clients[key]
+
+    auth = keystone_cache.CachedPassword(
+        cache_dir=KEYSTONE_CACHE_DIR,
         auth_url=auth_url,
         tenant_name=tenant,
         username=username,
@@ -38,16 +57,103 @@ def client_session(auth_url, tenant, username, password, region=None):
         region_name=region,
     )
 
-    return heatclient.client.Client(
+    _clients[key] = heatclient.client.Client(
         version=1,
         endpoint=heat_endpoint,
         session=keystone_session,
     )
+    return _clients[key]
 
 
-def deploy(name, template_file, heat_client, **kwargs):
+class StackFailure(Exception):
+    """
+    Raised when a stack, or one of its resources, fails to deploy.
     """
-    Deploy infrastructure by heat.
+
+
+def _event_time(event):
+    # Heat reports times either as '2015-06-01T10:00:00Z' or with
+    # fractional seconds and no suffix, '2015-06-01T10:00:00.123456'.
+    timestamp = event.event_time.rstrip('Z')
+    if '.' in timestamp:
+        return datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f')
+    return datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S')
+
+
+def wait_for_stack(heat_client, stack_id, timeout=600, interval=2,
+                   max_interval=15, on_event=None):
+    """
+    Wait for a stack to be created, following its events as they come.
+
+    Stack events are fetched incrementally using the last seen event as
+    marker.  The wait stops as soon as the stack or any of its resources
+    reaches a FAILED state.  Polling happens every `interval` seconds while
+    events keep coming, and backs off up to `max_interval` seconds when
+    nothing happens.
+
+    :param heat_client: heat client
+    :type heat_client: :py:class:`heatclient.client.Client`
+    :param stack_id: id of the stack to wait for
+    :type stack_id: string
+    :param timeout: seconds after which the deployment is considered failed
+    :type timeout: int
+    :param interval: shortest delay between two polls (seconds)
+    :type interval: int
+    :param max_interval: longest delay between two polls (seconds)
+    :type max_interval: int
+    :param on_event: function called with each new stack event (optional)
+    :type on_event: function
+    :return: tuple of the stack and a dict of resource creation times
+        (seconds) by resource name
+    """
+    deadline = time.time() + timeout
+    delay = interval
+    marker = None
+    started = {}
+    creation_times = {}
+    while True:
+        events = heat_client.events.list(
+            stack_id, marker=marker, sort_dir='asc')
+        for event in events:
+            marker = event.id
+            resource = event.resource_name
+            status = event.resource_status
+            if status == 'CREATE_IN_PROGRESS':
+                started.setdefault(resource, _event_time(event))
+            elif status == 'CREATE_COMPLETE' and resource in started:
+                elapsed = _event_time(event) - started[resource]
+                creation_times[resource] = elapsed.total_seconds()
+            elif status.endswith('FAILED'):
+                raise StackFailure(
+                    "Resource '{0:s}' of stack '{1:s}' went {2:s}: "
+                    "{3:s}".format(resource, stack_id, status,
+                                   event.resource_status_reason or '')
+                )
+            if on_event is not None:
+                on_event(event)
+
+        stack = heat_client.stacks.get(stack_id)
+        if stack.status == 'COMPLETE':
+            return stack, creation_times
+        elif stack.status == 'FAILED':
+            raise StackFailure(
+                "Deployment of stack '{0:s}' failed: {1:s}".format(
+                    stack_id, stack.stack_status_reason or '')
+            )
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise StackFailure(
+                "Deployment of infrastructure timed out. "
+                "Stack id: '{0:s}' / {1:s}".format(stack_id, stack.status)
+            )
+        delay = interval if events else min(delay * 1.5, max_interval)
+        time.sleep(min(delay, remaining))
+
+
+def create(name, template_file, heat_client, transform=None, **kwargs):
+    """
+    Request the creation of a heat stack, without waiting for it.
 
     :param name: heat stack name
     :type name: string
@@ -55,30 +161,101 @@ def deploy(name, template_file, heat_client, **kwargs):
     :type template_file: string
     :param heat_client: heat client
     :type heat_client: :py:class:`heatclient.client.Client`
+    :param transform: function taking the parsed template, and returning
+        the template to deploy (optional)
+    :type transform: function
     :param kwargs: template parameters
     :type kwargs: keyword arguments
-    :return: deployed stack
+    :return: stack id
     """
     tpl_files, template = template_utils.get_template_contents(template_file)
+    if transform is not None:
+        template = transform(template)
     api_response = heat_client.stacks.create(
         stack_name=name,
         template=template,
         files=tpl_files,
         parameters=kwargs,
     )
+    return api_response['stack']['id']
 
-    stack_id = api_response['stack']['id']
 
-    # Wait for deployment to complete.
-    retries = 60
-    for retry in range(retries):
-        time.sleep(5)
-        stack = heat_client.stacks.get(stack_id)
-        if stack.status == 'COMPLETE':
-            break
-    else:
-        raise Exception(
-            "Deployment of infrastructure failed. "
-            "Stack id: '{0:s}' / {1:s}".format(stack_id, stack.status)
-        )
+def deploy(name, template_file, heat_client, stack_timeout=600,
+           on_event=None, **kwargs):
+    """
+    Deploy infrastructure by heat.
+
+    :param name: heat stack name
+    :type name: string
+    :param template_file: heat template to deploy
+    :type template_file: string
+    :param heat_client: heat client
+    :type heat_client: :py:class:`heatclient.client.Client`
+    :param stack_timeout: seconds allowed for the deployment
+    :type stack_timeout: int
+    :param on_event: function called with each stack event (optional)
+    :type on_event: function
+    :param kwargs: template parameters
+    :type kwargs: keyword arguments
+    :return: deployed stack
+    """
+    stack_id = create(name, template_file, heat_client, **kwargs)
+    stack, creation_times = wait_for_stack(
+        heat_client, stack_id, stack_timeout, on_event=on_event)
+    print_creation_times(creation_times)
     return stack
+
+
+def print_creation_times(creation_times):
+    """
+    Print resource creation times, slowest first.
+
+    :param creation_times: seconds by resource name, see `wait_for_stack`
+    :type creation_times: dict
+    """
+    for resource, seconds in sorted(creation_times.items(),
+                                    key=lambda item: item[1], reverse=True):
+        print('Created {0:s} in {1:.0f}s'.format(resource, seconds))
+
+
+def wait_for_resource(heat_client, stack_id, resource_name, timeout=600,
+                      interval=2, max_interval=15):
+    """
+    Wait for a single resource of a stack to be created.
+
+    :param heat_client: heat client
+    :type heat_client: :py:class:`heatclient.client.Client`
+    :param stack_id: id of the stack holding the resource
+    :type stack_id: string
+    :param resource_name: logical name of the resource
+    :type resource_name: string
+    :param timeout: seconds after which the creation is considered failed
+    :type timeout: int
+    :param interval: first delay between two polls (seconds)
+    :type interval: int
+    :param max_interval: longest delay between two polls (seconds)
+    :type max_interval: int
+    :return: the created resource
+    """
+    deadline = time.time() + timeout
+    delay = interval
+    while True:
+        resource = heat_client.resources.get(stack_id, resource_name)
+        status = resource.resource_status
+        if status == 'CREATE_COMPLETE':
+            return resource
+        elif status.endswith('FAILED'):
+            raise StackFailure(
+                "Resource '{0:s}' of stack '{1:s}' went {2:s}: "
+                "{3:s}".format(resource_name, stack_id, status,
+                               resource.resource_status_reason or '')
+            )
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise StackFailure(
+                "Resource '{0:s}' of stack '{1:s}' not created in "
+                "{2:d}s".format(resource_name, stack_id, timeout)
+            )
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 1.5, max_interval)
@@ -0,0 +1 @@
+../../utils/jobtool/keystone_cache.py
\ No newline at end of file
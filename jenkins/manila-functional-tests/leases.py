@@ -0,0 +1,187 @@
+import contextlib
+import copy
+import fcntl
+import hashlib
+import io
+import json
+import os
+import re
+import time
+
+DEFAULT_PATH = os.path.expanduser('~/.cache/manilaci/leases')
+
+# Lease states.
+BUILDING = 'building'
+READY = 'ready'
+CLAIMED = 'claimed'
+
+# Time after which a lease still building is taken for abandoned, its build
+# having been killed before it could remove it (seconds).
+BUILD_TIMEOUT = 3 * 3600
+
+
+def lease_key(template_file, image, release, topology=None):
+    """
+    Get the key of the deployments which are interchangeable: same heat
+    template, image, RING release and topology.
+
+    :param template_file: path of the heat template
+    :type template_file: string
+    :param image: glance image
+    :type image: string
+    :param release: RING release
+    :type release: string
+    :param topology: server counts by role (optional)
+    :type topology: dict
+    :return: string
+    """
+    with io.open(template_file, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:16]
+    key = '{0:s}_{1:s}_{2:s}'.format(
+        digest, re.sub(r'[^\w.-]', '_', image), release)
+    if topology:
+        key += '_' + '-'.join('{0:s}{1:d}'.format(role, count)
+                              for role, count in sorted(topology.items()))
+    return key
+
+
+class LeaseStore(object):
+    """
+    Deployments kept across CI runs of this host, to be claimed by a run
+    instead of deploying from scratch, and released afterwards.
+
+    Leases are kept in a JSON file, and each lease has its own journal of
+    deployment stages (see :py:class:`stages.Journal`).  Changes are done
+    under a file lock, so that concurrent runs never claim the same lease.
+
+    :param path: directory of the store
+    :type path: string
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def journal_path(self, stack_id):
+        """
+        :return: path of the stage journal of a leased deployment
+        """
+        return os.path.join(self.path, '{0:s}.journal'.format(stack_id))
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # Leases are saved only if changed, reads leave the file alone.
+        with open(os.path.join(self.path, 'lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                leases = self._load()
+                loaded = copy.deepcopy(leases)
+                yield leases
+                if leases != loaded:
+                    self._save(leases)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self):
+        try:
+            with io.open(os.path.join(self.path, 'leases.json'), 'rb') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, leases):
+        path = os.path.join(self.path, 'leases.json')
+        with io.open(path + '.tmp', 'wb') as f:
+            json.dump(leases, f, indent=2)
+        os.rename(path + '.tmp', path)
+
+    def add(self, stack_id, key):
+        """
+        Record a deployment being built for a lease.
+        """
+        with self._locked() as leases:
+            leases[stack_id] = {
+                'key': key,
+                'state': BUILDING,
+                'created_at': time.time(),
+            }
+
+    def set_state(self, stack_id, state):
+        with self._locked() as leases:
+            if stack_id in leases:
+                leases[stack_id]['state'] = state
+
+    def remove(self, stack_id):
+        """
+        Forget a lease, and its journal.
+        """
+        with self._locked() as leases:
+            leases.pop(stack_id, None)
+        try:
+            os.unlink(self.journal_path(stack_id))
+        except OSError:
+            pass
+
+    def get(self, stack_id):
+        with self._locked() as leases:
+            return leases.get(stack_id)
+
+    def leases(self, key=None):
+        """
+        :return: dict of leases by stack id, of a key or all of them
+        """
+        with self._locked() as leases:
+            return dict((stack_id, lease) for stack_id, lease in leases.items()
+                        if key is None or lease['key'] == key)
+
+    def claim(self, key, max_age):
+        """
+        Claim the newest ready lease of a key, younger than `max_age`.
+
+        :param key: lease key, see :py:func:`lease_key`
+        :type key: string
+        :param max_age: maximum lease age (seconds)
+        :type max_age: int
+        :return: stack id, or `None` if there is no such lease
+        """
+        with self._locked() as leases:
+            candidates = [
+                (lease['created_at'], stack_id)
+                for stack_id, lease in leases.items()
+                if lease['key'] == key and lease['state'] == READY and
+                lease['created_at'] > time.time() - max_age
+            ]
+            if not candidates:
+                return None
+            _, stack_id = max(candidates)
+            leases[stack_id]['state'] = CLAIMED
+            return stack_id
+
+    def expired(self, key, max_age, build_timeout=BUILD_TIMEOUT):
+        """
+        Get the ready leases of a key older than `max_age`, and the leases
+        of a key still building after `build_timeout`, and mark them as
+        claimed so that no run uses them while they are replaced.
+
+        :param key: lease key, see :py:func:`lease_key`
+        :type key: string
+        :param max_age: maximum age of ready leases (seconds)
+        :type max_age: int
+        :param build_timeout: maximum age of building leases (seconds)
+        :type build_timeout: int
+        :return: list of stack ids
+        """
+        now = time.time()
+        with self._locked() as leases:
+            stack_ids = [
+                stack_id for stack_id, lease in leases.items()
+                if lease['key'] == key and (
+                    lease['state'] == READY and
+                    lease['created_at'] <= now - max_age or
+                    lease['state'] == BUILDING and
+                    lease['created_at'] <= now - build_timeout)
+            ]
+            for stack_id in stack_ids:
+                leases[stack_id]['state'] = CLAIMED
+            return stack_ids
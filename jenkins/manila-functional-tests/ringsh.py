@@ -0,0 +1,49 @@
+import os
+import pipes
+
+from fabric.api import run
+
+# Directory recording the ringsh commands done on a host, see
+# `ringsh_once`.
+ONCE_DIR = '/var/tmp/manilaci-ringsh'
+
+
+def ringsh(command, warn_only=False):
+    """
+    Run a ringsh command on the current host.
+
+    Each command runs in its own ringsh process, whose exit status tells
+    whether the command succeeded: ringsh reading commands on stdin gives
+    no status per command.
+
+    :param command: command, eg `supervisor serverList`
+    :type command: string
+    :param warn_only: whether a failure of the command is tolerated
+    :type warn_only: bool
+    :return: fabric result, with `succeeded` and `failed` attributes
+    """
+    return run('ringsh {0:s}'.format(command), warn_only=warn_only)
+
+
+def ringsh_once(command, key):
+    """
+    Run a ringsh command on the current host, unless it already succeeded
+    there under the same key, for commands whose outcome ringsh gives no
+    way to list.
+
+    Concurrent calls with the same key run one after the other, under a
+    lock, so that only the first one runs the command.  A failure of the
+    command is fatal.
+
+    :param command: command, eg `supervisor addVolume ...`
+    :type command: string
+    :param key: name of the outcome of the command, eg `volume-nfs`
+    :type key: string
+    :return: fabric result, empty if the command was not run
+    """
+    marker = os.path.join(ONCE_DIR, key)
+    script = 'test -f {marker:s} || {{ ringsh {command:s} && touch ' \
+             '{marker:s}; }}'.format(marker=pipes.quote(marker),
+                                     command=command)
+    return run('mkdir -p {0:s} && flock {1:s} sh -c {2:s}'.format(
+        ONCE_DIR, pipes.quote(marker + '.lock'), pipes.quote(script)))
@@ -0,0 +1,308 @@
+import collections
+import io
+import json
+import multiprocessing
+import os
+import Queue
+import time
+import traceback
+
+
+class Result(object):
+    """
+    Placeholder for the return value of a stage, in the arguments of another.
+
+    :param stage: name of the stage whose result is used
+    :type stage: string
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+
+
+class StageFailure(Exception):
+    """
+    Raised when a stage of a :py:class:`Scheduler` fails.
+    """
+
+
+Stage = collections.namedtuple('Stage',
+                               'name func args kwargs requires check '
+                               'interruptible')
+
+
+def _run_stage(queue, name, func, args, kwargs):
+    try:
+        queue.put((name, True, func(*args, **kwargs)))
+    except BaseException:
+        # Fabric aborts with SystemExit, report it like any other error.
+        queue.put((name, False, traceback.format_exc()))
+
+
+class Scheduler(object):
+    """
+    Run deployment stages as a dependency graph.
+
+    Every stage runs in its own process as soon as all the stages it
+    requires are done, so that stages acting on different hosts, or
+    independent stages on a same host, run concurrently.  Processes keep
+    Fabric's global state apart, as `fabric.decorators.parallel` does.
+
+    Once a stage fails no other stage is started, interruptible stages
+    still running are terminated, the others are waited for, then
+    :py:class:`StageFailure` is raised.
+    """
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.results = {}
+        self.times = {}
+
+    def add(self, name, func, *args, **kwargs):
+        """
+        Declare a stage.
+
+        :param name: unique stage name
+        :type name: string
+        :param func: function run by the stage, its return value must be
+            picklable
+        :type func: function
+        :param args: arguments of `func`, :py:class:`Result` instances are
+            replaced by the result of the named stage
+        :param kwargs: keyword arguments of `func`, and
+            - `requires`: names of the stages that must be done before this
+              one starts
+            - `check`: function taking the arguments of `func`, and
+              returning whether the outcome of an earlier run of the stage
+              is still in place, see :py:meth:`verify`
+            - `interruptible`: whether the stage may be terminated when
+              another stage fails, such as a stage only waiting for a
+              resource (default False)
+        """
+        requires = tuple(kwargs.pop('requires', ()))
+        check = kwargs.pop('check', None)
+        interruptible = kwargs.pop('interruptible', False)
+        for required in requires:
+            if required not in self.stages:
+                raise ValueError("Stage '{0:s}' requires unknown stage "
+                                 "'{1:s}'".format(name, required))
+        self.stages[name] = Stage(name, func, args, kwargs, requires, check,
+                                  interruptible)
+
+    def result(self, name):
+        """
+        :return: a placeholder for the result of stage `name`
+        """
+        return Result(name)
+
+    def _resolve(self, value):
+        if isinstance(value, Result):
+            return self.results[value.stage]
+        return value
+
+    def _arguments(self, stage):
+        args = [self._resolve(arg) for arg in stage.args]
+        kwargs = dict((key, self._resolve(value))
+                      for key, value in stage.kwargs.items())
+        return args, kwargs
+
+    def _start(self, stage, queue):
+        args, kwargs = self._arguments(stage)
+        process = multiprocessing.Process(
+            target=_run_stage,
+            args=(queue, stage.name, stage.func, args, kwargs),
+        )
+        process.start()
+        self.times[stage.name] = [time.time(), None]
+        print('[{0:s}] started'.format(stage.name))
+        return process
+
+    def verify(self, done):
+        """
+        Find the stages of an earlier run which are still done.
+
+        Stages are considered in declaration order.  A stage is still done
+        if it was done, all the stages it requires are still done, and its
+        check, if any, passes.  Checks run in this process, one after the
+        other.
+
+        :param done: results of the stages done in an earlier run, by name
+        :type done: dict
+        :return: results of the stages still done, by name
+        """
+        verified = {}
+        saved, self.results = self.results, verified
+        try:
+            for name, stage in self.stages.items():
+                if name not in done or not all(
+                        required in verified for required in stage.requires):
+                    continue
+                if stage.check is not None:
+                    args, kwargs = self._arguments(stage)
+                    if not stage.check(*args, **kwargs):
+                        print('[{0:s}] to be run again'.format(name))
+                        continue
+                print('[{0:s}] still done'.format(name))
+                verified[name] = done[name]
+        finally:
+            self.results = saved
+        return verified
+
+    def run(self, skip=(), on_done=None):
+        """
+        Run all stages.
+
+        :param skip: stages considered done without running them: a dict of
+            their results by name, or their names
+        :type skip: dict or iterable of strings
+        :param on_done: function called with the name and result of each
+            stage once done, in this process
+        :type on_done: function
+        :return: dict of stage results by stage name
+        """
+        if isinstance(skip, dict):
+            self.results.update(skip)
+        queue = multiprocessing.Queue()
+        pending = [name for name in self.stages if name not in skip]
+        done = set(skip)
+        running = {}
+        failures = []
+
+        while pending or running:
+            if not failures:
+                for name in list(pending):
+                    stage = self.stages[name]
+                    if all(required in done for required in stage.requires):
+                        pending.remove(name)
+                        running[name] = self._start(stage, queue)
+                if not running:
+                    raise StageFailure(
+                        'Stages cannot be scheduled: {0:s}'.format(
+                            ', '.join(pending)))
+            elif not running:
+                break
+
+            try:
+                name, succeeded, value = queue.get(timeout=1)
+            except Queue.Empty:
+                # A process killed from the outside never reports back.
+                for name, process in running.items():
+                    if not process.is_alive() and process.exitcode != 0:
+                        queue.put((name, False, 'Process exited with '
+                                   '{0}'.format(process.exitcode)))
+                continue
+
+            running.pop(name).join()
+            self.times[name][1] = time.time()
+            if succeeded:
+                print('[{0:s}] done in {1:.0f}s'.format(
+                    name, self.times[name][1] - self.times[name][0]))
+                self.results[name] = value
+                done.add(name)
+                if on_done is not None:
+                    on_done(name, value)
+            else:
+                print('[{0:s}] failed:\n{1:s}'.format(name, value))
+                failures.append(name)
+                self._interrupt(running)
+
+        self.report()
+        if failures:
+            raise StageFailure(
+                'Failed stages: {0:s}'.format(', '.join(failures)))
+        return self.results
+
+    def _interrupt(self, running):
+        for name, process in running.items():
+            if self.stages[name].interruptible:
+                process.terminate()
+                process.join()
+                del running[name]
+                self.times[name][1] = time.time()
+                print('[{0:s}] interrupted'.format(name))
+
+    def critical_path(self):
+        """
+        Get the chain of stages which determined the total duration.
+
+        Starting from the stage which finished last, follow the required
+        stage which finished last.
+
+        :return: list of stage names, in execution order
+        """
+        finished = dict((name, end) for name, (start, end)
+                        in self.times.items() if end is not None)
+        path = []
+        candidates = list(finished)
+        while candidates:
+            name = max(candidates, key=lambda candidate: finished[candidate])
+            path.append(name)
+            candidates = [required for required in self.stages[name].requires
+                          if required in finished]
+        return list(reversed(path))
+
+    def report(self):
+        """
+        Print stage durations and the critical path.
+        """
+        if not self.times:
+            return
+        origin = min(start for start, _ in self.times.values())
+        print('Stage timings (start offset / duration):')
+        for name in self.stages:
+            if name not in self.times:
+                continue
+            start, end = self.times[name]
+            duration = '{0:.0f}s'.format(end - start) if end else 'unfinished'
+            print('  {0:<28s} +{1:>5.0f}s {2:>10s}'.format(
+                name, start - origin, duration))
+        path = self.critical_path()
+        if path:
+            total = self.times[path[-1]][1] - origin
+            print('Critical path ({0:.0f}s): {1:s}'.format(
+                total, ' -> '.join(path)))
+
+
+class Journal(object):
+    """
+    Record of the stages done by a deployment, one JSON line per stage, so
+    that a later run can skip them.
+
+    :param path: path of the journal file
+    :type path: string
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def record(self, name, result):
+        """
+        Record a stage as done, suitable as `on_done` of
+        :py:meth:`Scheduler.run`.
+        """
+        with io.open(self.path, 'ab') as f:
+            f.write(json.dumps({'stage': name, 'result': result}) + '\n')
+
+    def load(self):
+        """
+        :return: results of the recorded stages, by name
+        """
+        done = {}
+        try:
+            with io.open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Partial line of an interrupted run.
+                        continue
+                    done[entry['stage']] = entry['result']
+        except IOError:
+            pass
+        return done
+
+    def reset(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Deployment modules import each other as top-level modules, as in fab.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
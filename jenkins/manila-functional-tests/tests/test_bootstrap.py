@@ -0,0 +1,51 @@
+import subprocess
+
+import pytest
+
+import bootstrap
+
+LISTING = """
+Server(name=MyRing, address=10.0.0.12, port=7084)
+sfused-nfs-sa 10.0.0.3:7084
+"""
+
+
+def test_listed_servers_exact_addresses():
+    servers = bootstrap.listed_servers(LISTING)
+
+    assert '10.0.0.12' in servers
+    assert '10.0.0.3' in servers
+    assert '10.0.0.1' not in servers
+    assert '10.0.0.30' not in servers
+
+
+@pytest.fixture
+def fake_ringsh(tmpdir, monkeypatch):
+    # Batched commands run in a local shell, ringsh being a script which
+    # fails for the nodes of 10.0.0.2.
+    script = tmpdir.join('ringsh')
+    script.write('#!/bin/sh\n'
+                 'case "$*" in *10.0.0.2*) echo KO; exit 1;; esac\n'
+                 'echo "RUN $*"\n')
+    script.chmod(0o755)
+    monkeypatch.setattr(bootstrap, 'which', lambda command: str(script))
+    monkeypatch.setattr(bootstrap.env, 'host_string', 'supervisor')
+    calls = []
+
+    def sudo(command):
+        calls.append(command)
+        return subprocess.check_output(['bash', '-c', command])
+    monkeypatch.setattr(bootstrap, 'sudo', sudo)
+    return calls
+
+
+def test_ringsh_batch_single_call(fake_ringsh):
+    results = bootstrap._ringsh_batch(
+        ['supervisor nodeStatus {0:s} 8084'.format(host)
+         for host in ('10.0.0.1', '10.0.0.2', '10.0.0.3')],
+        warn_only=True)
+
+    assert len(fake_ringsh) == 1
+    assert [result.return_code for result in results] == [0, 1, 0]
+    assert results[0] == 'RUN supervisor nodeStatus 10.0.0.1 8084'
+    assert results[1] == 'KO'
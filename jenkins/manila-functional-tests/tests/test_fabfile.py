@@ -0,0 +1,48 @@
+import pytest
+
+import fabfile
+
+
+@pytest.fixture
+def paths(tmpdir, monkeypatch):
+    monkeypatch.setattr(fabfile, 'HOSTS_PATH', str(tmpdir.join('hosts')))
+    monkeypatch.setattr(fabfile, 'DEPLOYMENT_PATH',
+                        str(tmpdir.join('deployment')))
+    monkeypatch.setattr(fabfile, 'JOURNAL_PATH',
+                        str(tmpdir.join('deployment.journal')))
+    return tmpdir
+
+
+def test_hosts_written_exact_addresses(paths):
+    topology = fabfile._topology(nodes=2)
+    fabfile._write_hosts(topology, '10.0.0.12', '10.0.0.2', '10.0.0.3',
+                         '10.0.0.4')
+
+    assert fabfile._hosts_written(topology, '10.0.0.12', '10.0.0.2',
+                                  '10.0.0.3', '10.0.0.4')
+    assert not fabfile._hosts_written(topology, '10.0.0.1', '10.0.0.2',
+                                      '10.0.0.3', '10.0.0.4')
+    assert not fabfile._hosts_written(topology, '10.0.0.12', '10.0.0.2',
+                                      '10.0.0.4', '10.0.0.3')
+
+
+def test_hosts_not_written(paths):
+    assert not fabfile._hosts_written(fabfile._topology(), '10.0.0.1',
+                                      '10.0.0.2', '10.0.0.3')
+
+
+def test_deployment_forgotten(paths):
+    fabfile._record_deployment('stack', fabfile._topology())
+    paths.join('deployment.journal').write('{}\n')
+
+    fabfile._forget_deployment()
+
+    assert not paths.join('deployment').check()
+    assert not paths.join('deployment.journal').check()
+    with pytest.raises(SystemExit):
+        fabfile._recorded_deployment()
+
+
+def test_connector_names_unique():
+    assert fabfile._connector_name('nfs', 1) == 'nfs'
+    assert fabfile._connector_name('nfs', '2') == 'nfs-2'
@@ -0,0 +1,56 @@
+import time
+
+import pytest
+
+import leases
+
+
+@pytest.fixture
+def store(tmpdir):
+    return leases.LeaseStore(str(tmpdir))
+
+
+def age(store, stack_id, seconds):
+    with store._locked() as entries:
+        entries[stack_id]['created_at'] = time.time() - seconds
+
+
+def test_claim_newest_ready(store):
+    for stack_id, seconds in (('old', 20), ('new', 10), ('building', 0)):
+        store.add(stack_id, 'key')
+        age(store, stack_id, seconds)
+    store.set_state('old', leases.READY)
+    store.set_state('new', leases.READY)
+
+    assert store.claim('key', 3600) == 'new'
+    assert store.claim('key', 3600) == 'old'
+    assert store.claim('key', 3600) is None
+
+
+def test_expired_ready(store):
+    store.add('stack', 'key')
+    store.set_state('stack', leases.READY)
+    age(store, 'stack', 7200)
+
+    assert store.expired('other', 3600) == []
+    assert store.expired('key', 3600) == ['stack']
+    assert store.get('stack')['state'] == leases.CLAIMED
+    assert store.claim('key', 3600 * 24) is None
+
+
+def test_expired_abandoned_build(store):
+    store.add('abandoned', 'key')
+    age(store, 'abandoned', leases.BUILD_TIMEOUT + 60)
+    store.add('running', 'key')
+
+    assert store.expired('key', 3600) == ['abandoned']
+    assert store.get('running')['state'] == leases.BUILDING
+
+
+def test_reads_do_not_save(store, monkeypatch):
+    store.add('stack', 'key')
+    monkeypatch.setattr(store, '_save', lambda leases: pytest.fail(
+        'leases saved by a read'))
+
+    assert store.get('stack')['state'] == leases.BUILDING
+    assert list(store.leases('key')) == ['stack']
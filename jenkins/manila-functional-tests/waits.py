@@ -0,0 +1,121 @@
+import random
+import time
+
+
+class WaitFailure(Exception):
+    """
+    Raised when a wait ends on an error which is not worth retrying.
+
+    :param description: what was waited for
+    :type description: string
+    :param attempts: number of attempts made
+    :type attempts: int
+    :param error: last result or exception
+    """
+
+    def __init__(self, description, attempts, error):
+        super(WaitFailure, self).__init__(
+            'Failed waiting for {0:s} after {1:d} attempt(s): {2!s}'.format(
+                description, attempts, error))
+        self.description = description
+        self.attempts = attempts
+        self.error = error
+
+
+class WaitTimeout(WaitFailure):
+    """
+    Raised when the deadline of a wait is reached.
+    """
+
+    def __init__(self, description, attempts, error, elapsed):
+        Exception.__init__(
+            self,
+            'Gave up waiting for {0:s} after {1:d} attempt(s) in {2:.0f}s: '
+            '{3!s}'.format(description, attempts, elapsed, error))
+        self.description = description
+        self.attempts = attempts
+        self.error = error
+        self.elapsed = elapsed
+
+
+def succeeded(result):
+    """
+    Default success predicate: fabric results which succeeded, or any other
+    true value.
+    """
+    return getattr(result, 'succeeded', bool(result))
+
+
+def _never(error):
+    return False
+
+
+def _always(error):
+    return True
+
+
+def wait(attempt, description, predicate=succeeded, retriable=None,
+         timeout=120, interval=1, max_interval=15, factor=2, jitter=0.5):
+    """
+    Call `attempt` until its result satisfies `predicate`.
+
+    The first attempt is made right away.  Delays between attempts grow
+    exponentially from `interval` up to `max_interval`, and are randomly
+    shortened by up to `jitter` (a fraction of the delay), so that
+    concurrent waits spread out.  The time spent and number of attempts are
+    printed once done.
+
+    :param attempt: function taking no argument
+    :type attempt: function
+    :param description: what is waited for, for messages
+    :type description: string
+    :param predicate: function taking the result of an attempt, and
+        returning whether it is successful
+    :type predicate: function
+    :param retriable: function taking an unsuccessful result or the
+        exception raised by an attempt, and returning whether to try again.
+        By default unsuccessful results are retried, and exceptions are
+        raised.
+    :type retriable: function
+    :param timeout: overall deadline (seconds)
+    :type timeout: int
+    :param interval: initial delay between attempts (seconds)
+    :type interval: float
+    :param max_interval: maximum delay between attempts (seconds)
+    :type max_interval: float
+    :param factor: growth factor of the delay between attempts
+    :type factor: float
+    :param jitter: fraction of each delay which may be randomly cut
+    :type jitter: float
+    :return: the successful result
+    :raises: :py:class:`WaitTimeout` once the deadline is reached,
+        :py:class:`WaitFailure` on an error not to retry
+    """
+    start = time.time()
+    deadline = start + timeout
+    delay = interval
+    attempts = 0
+
+    while True:
+        attempts += 1
+        try:
+            result = attempt()
+        except Exception as e:
+            if not (retriable or _never)(e):
+                raise
+            error = e
+        else:
+            if predicate(result):
+                print('Waited {0:.1f}s for {1:s} ({2:d} attempt(s))'.format(
+                    time.time() - start, description, attempts))
+                return result
+            if not (retriable or _always)(result):
+                raise WaitFailure(description, attempts, result)
+            error = result
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise WaitTimeout(description, attempts, error,
+                              time.time() - start)
+        time.sleep(min(remaining, delay * (1 - random.uniform(0, jitter))))
+        delay = min(max_interval, delay * factor)
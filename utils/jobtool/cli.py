@@ -1,12 +1,31 @@
 #!/usr/bin/python
 
+import collections
+import io
+import json
+import os
+import re
+import select
+import shutil
+import socket
 import subprocess
+import sys
+import threading
 import time
+import uuid
+
+from multiprocessing.pool import ThreadPool
 
 import click
+import keystoneclient.session
 import novaclient.client
+import novaclient.exceptions
 import paramiko
 
+import inventory
+import keystone_cache
+import spans
+
 
 # NOVA related functions
 
@@ -18,7 +37,9 @@ def find_available_ip(client):
 
 
 def find_server(client, server_name):
-    for server in client.servers.list():
+    # Nova treats the name filter as a regular expression.
+    search_opts = {'name': '^%s$' % re.escape(server_name)}
+    for server in client.servers.list(search_opts=search_opts):
         if server.name == server_name:
             return server
 
@@ -29,32 +50,150 @@ def find_image(client, image_name):
             return image
 
 
+def server_ips(server):
+    """ Return the (private, floating) IPs of a server, floating may be None.
+    """
+    addresses = server.networks.get('private', [])
+    private_ip = addresses[0] if addresses else None
+    floating_ip = addresses[1] if len(addresses) > 1 else None
+    return private_ip, floating_ip
+
+
+def lookup_server(client, inv, server_name):
+    """ Find a server through the inventory, falling back to Nova
+    when the inventory has no entry or a stale one.
+    """
+    entry = inv.get_server(server_name)
+    if entry is not None:
+        try:
+            server = client.servers.get(entry['server_id'])
+        except novaclient.exceptions.NotFound:
+            inv.remove_server(server_name)
+        else:
+            private_ip, floating_ip = server_ips(server)
+            if floating_ip != entry['floating_ip']:
+                # The floating IP was changed outside jobtool.
+                inv.add_server(server_name, server.id, private_ip,
+                               floating_ip, None, entry['image_id'])
+            return server
+
+    server = find_server(client, server_name)
+    if server is not None:
+        private_ip, floating_ip = server_ips(server)
+        inv.add_server(server_name, server.id, private_ip, floating_ip)
+    return server
+
+
+def lookup_image(client, inv, image_name):
+    image_id = inv.get_image(image_name)
+    if image_id is not None:
+        try:
+            return client.images.get(image_id)
+        except novaclient.exceptions.NotFound:
+            inv.remove_image(image_name)
+
+    image = find_image(client, image_name)
+    if image is not None:
+        inv.add_image(image_name, image.id)
+    return image
+
+
+def lookup_ip(client, inv, server_name, ip):
+    entry = inv.get_server(server_name)
+    if entry is not None and entry['floating_ip_id'] is not None:
+        try:
+            return client.floating_ips.get(entry['floating_ip_id'])
+        except novaclient.exceptions.NotFound:
+            pass
+    return find_ip(client, ip)
+
+
 def create_floating_ip(client):
     return client.floating_ips.create()
 
 
+class ServerError(Exception):
+    pass
+
+
+def wait_for_server(client, server_id, ready, deadline, interval=1,
+                    max_interval=10):
+    """ Poll a single server until `ready(server)` holds.
+
+    The polling interval grows by half on every attempt, up to
+    `max_interval`. Raises `ServerError` as soon as the server goes to ERROR
+    or DELETED, or once the `deadline` timestamp has passed.
+    """
+    while True:
+        server = client.servers.get(server_id)
+        if server.status in ('ERROR', 'DELETED'):
+            fault = getattr(server, 'fault', {}) or {}
+            raise ServerError("Server '%s' went to %s: %s" % (
+                server.name, server.status, fault.get('message', 'no fault')))
+        if ready(server):
+            return server
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise ServerError("Server '%s' not ready in time (status %s)"
+                              % (server.name, server.status))
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 1.5, max_interval)
+
+
 def start_server(nova_client, image_name, server_name, server_flavor,
-                 ssh_key_name, add_floating_ip=True):
+                 ssh_key_name, add_floating_ip=True, inv=None, timeout=600,
+                 timings=None):
+    """ Boot a server and wait for it to be ACTIVE, and for its floating IP
+    to be attached when `add_floating_ip` is set.
 
-    image = find_image(nova_client, image_name)
+    The time spent in each phase ('build', 'active', 'floating_ip') is
+    stored in the `timings` dict when one is given.
+    """
+    if timings is None:
+        timings = {}
+    deadline = time.time() + timeout
+
+    if inv is not None:
+        image = lookup_image(nova_client, inv, image_name)
+    else:
+        image = find_image(nova_client, image_name)
     assert image is not None, "No image %s found" % image_name
 
-    server = nova_client.servers.create(
-        name=server_name, image=image, flavor=server_flavor,
-        key_name=ssh_key_name)
-    while server.status != 'ACTIVE':
-        time.sleep(2)
-        print "Waiting for server to boot"
-        server = find_server(nova_client, server_name)
-        assert server is not None, "No server '%s' found" % server_name
+    with spans.span('start_server.build', server=server_name) as span:
+        server = nova_client.servers.create(
+            name=server_name, image=image, flavor=server_flavor,
+            key_name=ssh_key_name)
+    timings['build'] = span.duration
+
+    print "Waiting for server %s to boot" % server_name
+    with spans.span('start_server.active', server=server_name) as span:
+        server = wait_for_server(
+            nova_client, server.id, lambda srv: srv.status == 'ACTIVE',
+            deadline)
+    timings['active'] = span.duration
 
     floating_ip = None
     if add_floating_ip:
-        floating_ip = create_floating_ip(nova_client)
-        assert floating_ip is not None, "No available IP found"
-        server.add_floating_ip(floating_ip)
+        with spans.span('start_server.floating_ip',
+                        server=server_name) as span:
+            floating_ip = create_floating_ip(nova_client)
+            assert floating_ip is not None, "No available IP found"
+            server.add_floating_ip(floating_ip)
+            server = wait_for_server(
+                nova_client, server.id,
+                lambda srv: floating_ip.ip in server_ips(srv), deadline)
+        timings['floating_ip'] = span.duration
     private_ip = server.networks['private'][0]
 
+    if inv is not None:
+        inv.add_server(
+            server_name, server.id, private_ip,
+            floating_ip.ip if floating_ip else None,
+            floating_ip.id if floating_ip else None, image.id)
+
+    print "Server %s ready: %s" % (server_name, ", ".join(
+        "%s %.1fs" % (phase, timings[phase])
+        for phase in ('build', 'active', 'floating_ip') if phase in timings))
     return server, private_ip, floating_ip
 
 
@@ -64,14 +203,182 @@ def find_ip(client, ip):
             return ip_obj
 
 
+def map_concurrently(func, items, workers):
+    """ Apply `func` to every item through a pool of at most `workers`
+    threads, and return the results in order.
+    """
+    pool = ThreadPool(max(1, min(workers, len(items))))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+KillResult = collections.namedtuple('KillResult', 'name status duration')
+
+
+def wait_for_deletion(client, server_id, timeout=300):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            client.servers.get(server_id)
+        except novaclient.exceptions.NotFound:
+            return
+        time.sleep(2)
+    raise Exception("Server '%s' still present after %ds"
+                    % (server_id, timeout))
+
+
+def kill_server(client, server_obj, ip_obj=None, wait=False, timeout=300):
+    """ Release the floating IP of a server, if any, and delete it.
+    """
+    _, floating_ip = server_ips(server_obj)
+    if floating_ip is not None:
+        assert ip_obj is not None, "No IP '%s' found" % floating_ip
+        server_obj.remove_floating_ip(floating_ip)
+        client.floating_ips.delete(ip_obj)
+
+    server_obj.delete()
+    if wait:
+        wait_for_deletion(client, server_obj.id, timeout)
+
+
+def kill_servers(client, server_names, workers=8, wait=False, timeout=300):
+    """ Destroy many servers at once.
+
+    Servers and floating IPs are listed a single time, deletions then go
+    through a pool of `workers` threads. A failure on one server does not
+    abort the others: one `KillResult` is returned per server name.
+    """
+    servers = dict((srv.name, srv) for srv in client.servers.list())
+    ips = dict((ip.ip, ip) for ip in client.floating_ips.list())
+
+    def kill_one(name):
+        start = time.time()
+        try:
+            server_obj = servers.get(name)
+            assert server_obj is not None, "No server '%s' found" % name
+            _, floating_ip = server_ips(server_obj)
+            kill_server(client, server_obj, ips.get(floating_ip), wait,
+                        timeout)
+            status = 'confirmed' if wait else 'deleted'
+        except Exception as exc:
+            status = 'failed: %s' % exc
+        return KillResult(name, status, time.time() - start)
+
+    return map_concurrently(kill_one, server_names, workers)
+
+
 # END NOVA related functions
 
 
+def wait_for_ssh(ip, user, key_filename, timeout=300, port=22,
+                 interval=1, max_interval=10):
+    """ Wait for sshd on a freshly booted VM and return a connected
+    `paramiko.SSHClient`.
+
+    Each attempt checks that the TCP port accepts connections, that an SSH
+    banner is sent, then authenticates. Attempts are retried with an
+    exponential backoff until `timeout` seconds have passed.
+    """
+    deadline = time.time() + timeout
+    while True:
+        stage = 'port'
+        try:
+            sock = socket.create_connection((ip, port), timeout=5)
+            try:
+                stage = 'banner'
+                sock.settimeout(5)
+                banner = sock.recv(256)
+            finally:
+                sock.close()
+            if not banner.startswith('SSH-'):
+                raise paramiko.SSHException("Unexpected banner %r" % banner)
+
+            stage = 'authentication'
+            ssh_client = paramiko.SSHClient()
+            ssh_client.set_missing_host_key_policy(
+                paramiko.MissingHostKeyPolicy())
+            try:
+                ssh_client.connect(
+                    ip, port=port, username=user, key_filename=key_filename,
+                    timeout=10, banner_timeout=10)
+            except Exception:
+                ssh_client.close()
+                raise
+            return ssh_client
+        except (socket.error, paramiko.SSHException) as exc:
+            error = exc
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise Exception("SSH on %s:%d not ready after %ds (%s: %s)"
+                            % (ip, port, timeout, stage, error))
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+
+
+class LineWriter(object):
+    """ Write data chunks out line by line, to `out` and optionally to `log`.
+
+    At most `limit` bytes of an unterminated line are buffered before they
+    are written out as is.
+    """
+
+    def __init__(self, out, log=None, limit=64 * 1024):
+        self.out = out
+        self.log = log
+        self.limit = limit
+        self.pending = ''
+
+    def feed(self, data):
+        self.pending += data
+        end = self.pending.rfind('\n') + 1
+        if end == 0 and len(self.pending) >= self.limit:
+            end = len(self.pending)
+        if end:
+            self._write(self.pending[:end])
+            self.pending = self.pending[end:]
+
+    def flush(self):
+        if self.pending:
+            self._write(self.pending)
+            self.pending = ''
+
+    def _write(self, data):
+        self.out.write(data)
+        self.out.flush()
+        if self.log is not None:
+            self.log.write(data)
+
+
+class CommandError(Exception):
+    pass
+
+
 class SSHClientWrapper(object):
 
-    def __init__(self, client, user):
+    chunk_size = 32 * 1024
+
+    def __init__(self, client, user, log_file=None):
         self.client = client
         self.user = user
+        self.log_file = log_file
+        self._sftp = None
+
+    @property
+    def sftp(self):
+        """ SFTP session, opened on first use and shared by all transfers.
+        """
+        if self._sftp is None:
+            self._sftp = self.client.open_sftp()
+        return self._sftp
+
+    def close(self):
+        if self._sftp is not None:
+            self._sftp.close()
+            self._sftp = None
 
     @property
     def install_cmd(self):
@@ -83,38 +390,134 @@ class SSHClientWrapper(object):
 
     def install(self, *args):
         cmd = "sudo %s %s" % (self.install_cmd, ' '.join(args))
-        self.command(cmd)
+        self.check_command(cmd)
+
+    def command(self, cmd, log_file=None):
+        """ Run `cmd` on the VM and return its exit status.
 
-    def command(self, cmd):
-        stdin, stdout, stderr = self.client.exec_command(cmd, get_pty=True)
-        print stdout.read()
-        print stderr.read()
+        stdout and stderr are drained together and echoed as lines arrive,
+        so a chatty command can neither stall on a full window nor grow the
+        memory used here. Output is also appended to `log_file`, which
+        defaults to the log file of the wrapper.
+        """
+        log_file = log_file or self.log_file
+        log = open(log_file, 'a') if log_file else None
+        channel = self.client.get_transport().open_session()
+        try:
+            channel.get_pty()
+            channel.exec_command(cmd)
+            stdout = LineWriter(sys.stdout, log)
+            stderr = LineWriter(sys.stderr, log)
+            while True:
+                select.select([channel], [], [], 1)
+                while channel.recv_ready():
+                    stdout.feed(channel.recv(self.chunk_size))
+                while channel.recv_stderr_ready():
+                    stderr.feed(channel.recv_stderr(self.chunk_size))
+                if (channel.exit_status_ready() and channel.eof_received and
+                        not channel.recv_ready() and
+                        not channel.recv_stderr_ready()):
+                    break
+            stdout.flush()
+            stderr.flush()
+            return channel.recv_exit_status()
+        finally:
+            channel.close()
+            if log is not None:
+                log.close()
+
+    def check_command(self, cmd, log_file=None):
+        """ Run `cmd` on the VM, raise `CommandError` if it fails.
+        """
+        status = self.command(cmd, log_file)
+        if status != 0:
+            raise CommandError("Command '%s' failed with exit status %d"
+                               % (cmd, status))
 
     def create_pkey(self):
         cmd = ["openssl genrsa -aes128 -passout pass:x",
                "-out server.pass.key 2048"]
-        self.command(" ".join(cmd))
+        self.check_command(" ".join(cmd))
         cmd = ["openssl rsa -passin pass:x",
                "-in server.pass.key -out /home/%s/.ssh/id_rsa"
                % self.user]
-        self.command(" ".join(cmd))
-        self.command("chmod go-rw ~/.ssh/id_rsa")
-        self.command("rm server.pass.key")
+        self.check_command(" ".join(cmd))
+        self.check_command("chmod go-rw ~/.ssh/id_rsa")
+        self.check_command("rm server.pass.key")
 
     def clone_repo(self, repo, branch=None):
         command = "git clone"
         if branch:
             command += " -b %s" % branch
         command += " %s" % repo
-        self.command(command)
+        self.check_command(command)
 
     def write_file(self, data, path, mode=None):
-        sftp_client = self.client.open_sftp()
-        f = sftp_client.open(path, mode='w')
-        f.write(data)
-        f.close()
-        if mode:
-            sftp_client.chmod(path, mode)
+        self.put_file(io.BytesIO(data), path, mode)
+
+    def put_file(self, source, path, mode=None):
+        """ Stream the file object `source` to `path` on the VM.
+        """
+        f = self.sftp.open(path, mode='w')
+        try:
+            # Do not wait for the server to acknowledge each write,
+            # errors are reported on close.
+            f.set_pipelined(True)
+            shutil.copyfileobj(source, f, self.chunk_size)
+            if mode:
+                f.chmod(mode)
+        finally:
+            f.close()
+
+    def write_files(self, files):
+        """ Upload several files through the shared SFTP session.
+
+        `files` is an iterable of (data, path, mode) tuples, mode may be None.
+        """
+        for data, path, mode in files:
+            self.write_file(data, path, mode)
+
+    def put_tree(self, local_dir, remote_dir):
+        """ Upload a local directory tree, keeping the file permissions.
+        """
+        for dirpath, dirnames, filenames in os.walk(local_dir):
+            relative = os.path.relpath(dirpath, local_dir)
+            target = os.path.normpath(os.path.join(remote_dir, relative))
+            try:
+                self.sftp.stat(target)
+            except IOError:
+                self.sftp.mkdir(target)
+            for filename in filenames:
+                local_path = os.path.join(dirpath, filename)
+                with open(local_path, 'rb') as f:
+                    self.put_file(f, os.path.join(target, filename),
+                                  os.fstat(f.fileno()).st_mode & 0777)
+
+
+class Background(object):
+    """ Run a function in a thread, `join` returns its result or re-raises
+    its exception.
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self.result = None
+        self.exc_info = None
+        self.thread = threading.Thread(
+            target=self._run, args=(func, args, kwargs))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, func, args, kwargs):
+        try:
+            self.result = func(*args, **kwargs)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def join(self):
+        self.thread.join()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
 
 
 def interactive_connect(user, ip, ssh_key):
@@ -132,8 +535,10 @@ class ManilaTempestJob(object):
 
     def __init__(self, nova_client, ssh_wrapper, repo, raw_jo_params,
                  user, extra_image, extra_server, ssh_key_name,
-                 server_flavor):
+                 server_flavor, inv=None, provisioned=False):
         self.nova_client = nova_client
+        self.inv = inv
+        self.provisioned = provisioned
         self.ssh_wrapper = ssh_wrapper
         self.repo = repo
         self.user = user
@@ -151,17 +556,44 @@ class ManilaTempestJob(object):
         return result
 
     def run(self):
-        self.ssh_wrapper.install('git', 'vim')
-        self.ssh_wrapper.create_pkey()
-        self.ssh_wrapper.clone_repo(
-            self.repo, self.job_params['JOB_GIT_REVISION'])
-        extra_server, private_ip, floating_ip = start_server(
-            self.nova_client, self.extra_image, self.extra_server,
-            self.server_flavor, self.ssh_key_name, add_floating_ip=False)
-        self._write_tosource(private_ip)
-        self._write_clean()
-
-    def _write_tosource(self, private_ip):
+        """ The extra VM boots in the background while the main VM gets
+        provisioned, the job files need its private IP.
+        """
+        with spans.span('job.run', job=self.job_name) as total:
+            extra = Background(self._boot_extra_server)
+            with spans.span('job.provision', job=self.job_name) as provision:
+                self._provision()
+            with spans.span('job.wait_extra_vm', job=self.job_name) as wait:
+                private_ip, booted = extra.join()
+            with spans.span('job.write_files', job=self.job_name):
+                self.ssh_wrapper.write_files([
+                    self._tosource_file(private_ip),
+                    self._clean_file(),
+                ])
+        print ("%s: provisioning %.1fs, extra VM boot %.1fs (overlapped), "
+               "waited %.1fs for extra VM, total %.1fs" % (
+                   self.job_name, provision.duration, booted, wait.duration,
+                   total.duration))
+
+    def _provision(self):
+        if not self.provisioned:
+            with spans.span('job.install', job=self.job_name):
+                self.ssh_wrapper.install(*POOL_PACKAGES)
+        with spans.span('job.create_pkey', job=self.job_name):
+            self.ssh_wrapper.create_pkey()
+        with spans.span('job.clone_repo', job=self.job_name):
+            self.ssh_wrapper.clone_repo(
+                self.repo, self.job_params['JOB_GIT_REVISION'])
+
+    def _boot_extra_server(self):
+        with spans.span('job.extra_vm', job=self.job_name) as span:
+            extra_server, private_ip, floating_ip = start_server(
+                self.nova_client, self.extra_image, self.extra_server,
+                self.server_flavor, self.ssh_key_name, add_floating_ip=False,
+                inv=self.inv)
+        return private_ip, span.duration
+
+    def _tosource_file(self, private_ip):
         data = """#!/bin/bash
 export LC_ALL=en_US.UTF-8
 export WORKSPACE=$(pwd)/openstack-ci-scripts
@@ -173,9 +605,9 @@ export JCLOUDS_IPS="%s"
                 data += "export %s=%s\n" % (param, value)
 
         path = '/home/%s/tosource.sh' % self.user
-        self.ssh_wrapper.write_file(data, path)
+        return data, path, None
 
-    def _write_clean(self):
+    def _clean_file(self):
         data = """#!/bin/bash -xue
 openstack-ci-scripts/devstack/unstack.sh
 cd openstack-ci-scripts
@@ -185,7 +617,213 @@ rm /etc/manila/manila.conf
 sudo rm -r /opt/stack/manila-scality
 """
         path = '/home/%s/clean.sh' % self.user
-        self.ssh_wrapper.write_file(data, path, 0755)
+        return data, path, 0755
+
+
+def fan_out(nova_client, inv, params, make_job):
+    """ Launch `params['count']` job VMs and run a job on each of them.
+
+    VMs are named after `params['server']` with an index suffix. All of them
+    are booted at once, then at most `params['concurrency']` jobs run at the
+    same time. `make_job(ssh_wrapper, index)` returns the job to run on a VM.
+
+    A failure on one VM does not stop the others. Returns one dict per VM
+    with its IPs, per phase timings and error if any.
+    """
+    results = [
+        {'index': index, 'name': '%s-%d' % (params['server'], index),
+         'private_ip': None, 'floating_ip': None, 'error': None,
+         'timings': {}}
+        for index in range(1, params['count'] + 1)]
+
+    def boot(result):
+        start = time.time()
+        try:
+            server, private_ip, floating_ip = start_server(
+                nova_client, params['image'], result['name'],
+                params['server_flavor'], params['ssh_key_name'], inv=inv,
+                timeout=params['boot_timeout'], timings=result['timings'])
+            result['private_ip'] = private_ip
+            result['floating_ip'] = floating_ip.ip
+        except Exception as exc:
+            result['error'] = 'boot: %s' % exc
+        result['timings']['boot'] = time.time() - start
+
+    def run_job(result):
+        if result['error'] is not None:
+            return
+        phase = 'ssh'
+        try:
+            with spans.span('bootstrap.ssh', server=result['name']) as span:
+                ssh_client = wait_for_ssh(
+                    result['floating_ip'], params['user'], params['ssh_key'],
+                    timeout=params['ssh_timeout'])
+            result['timings']['ssh'] = span.duration
+
+            log_file = None
+            if params['log_file']:
+                log_file = '%s.%s' % (params['log_file'], result['name'])
+            ssh_wrapper = SSHClientWrapper(
+                ssh_client, params['user'], log_file)
+            try:
+                phase = 'job'
+                start = time.time()
+                make_job(ssh_wrapper, result['index']).run()
+                result['timings']['job'] = time.time() - start
+            finally:
+                ssh_wrapper.close()
+                ssh_client.close()
+        except Exception as exc:
+            result['error'] = '%s: %s' % (phase, exc)
+
+    map_concurrently(boot, results, len(results))
+    map_concurrently(run_job, results, params['concurrency'])
+    return results
+
+
+def report_fan_out(ctx, results):
+    summary = ctx.obj['bootstrap-params']['summary']
+    with open(summary, 'w') as f:
+        json.dump({'servers': results}, f, indent=2)
+
+    for result in results:
+        print "%-30s %-15s %-15s %s" % (
+            result['name'], result['floating_ip'], result['private_ip'],
+            result['error'] or ", ".join(
+                "%s %.1fs" % item for item in sorted(
+                    result['timings'].items())))
+    print "Summary written to %s" % summary
+    if any(result['error'] for result in results):
+        ctx.exit(1)
+
+
+# Packages pre-installed on pool members, required by every job.
+POOL_PACKAGES = ('git', 'vim')
+
+POOL_TTL = 4 * 3600
+
+
+def provision_pool_member(nova_client, inv, name, image, flavor,
+                          ssh_key_name, user, ssh_key):
+    """ Boot and provision a pool member registered as 'booting', and mark it
+    'ready'. A member that fails is destroyed and dropped from the pool.
+    """
+    try:
+        server, private_ip, floating_ip = start_server(
+            nova_client, image, name, flavor, ssh_key_name, inv=inv)
+        ssh_client = wait_for_ssh(floating_ip.ip, user, ssh_key)
+        try:
+            SSHClientWrapper(ssh_client, user).install(*POOL_PACKAGES)
+        finally:
+            ssh_client.close()
+        inv.set_pool_state(name, 'ready')
+    except Exception as exc:
+        print "Pool member %s failed: %s" % (name, exc)
+        recycle_pool_member(nova_client, inv, name)
+
+
+def recycle_pool_member(nova_client, inv, name):
+    server_obj = lookup_server(nova_client, inv, name)
+    if server_obj is not None:
+        _, floating_ip = server_ips(server_obj)
+        ip_obj = None
+        if floating_ip is not None:
+            ip_obj = lookup_ip(nova_client, inv, name, floating_ip)
+        kill_server(nova_client, server_obj, ip_obj)
+    inv.remove_server(name)
+    inv.remove_pool_member(name)
+
+
+def fill_pool(nova_client, inv, image, flavor, size, ssh_key_name, user,
+              ssh_key, ttl=POOL_TTL):
+    """ Recycle pool members older than `ttl` seconds, then boot as many
+    members as needed to have `size` of them for `image` and `flavor`.
+    """
+    now = time.time()
+    with inv.pool_lock():
+        members = inv.pool_members(image, flavor)
+        expired = [member['name'] for member in members
+                   if member['state'] != 'claimed' and
+                   member['created_at'] < now - ttl]
+        members = [member for member in members
+                   if member['state'] != 'claimed' and
+                   member['name'] not in expired]
+
+        slug = re.sub(r'[^a-z0-9]+', '-', image.lower()).strip('-')
+        names = ['jobtool-pool-%s-%s' % (slug, uuid.uuid4().hex[:8])
+                 for _ in range(size - len(members))]
+        for name in names:
+            inv.add_pool_member(name, image, flavor)
+        for name in expired:
+            inv.set_pool_state(name, 'recycling')
+
+    for name in expired:
+        print "Recycling pool member %s" % name
+        recycle_pool_member(nova_client, inv, name)
+    map_concurrently(
+        lambda name: provision_pool_member(
+            nova_client, inv, name, image, flavor, ssh_key_name, user,
+            ssh_key),
+        names, len(names))
+    return names
+
+
+def claim_pool_server(nova_client, inv, image, flavor, server_name,
+                      ttl=POOL_TTL):
+    """ Claim a ready pool member and rename it `server_name`.
+
+    Returns the inventory entry of the claimed server, or None when the pool
+    has no ready member.
+    """
+    while True:
+        name = inv.claim_pool_member(image, flavor, ttl)
+        if name is None:
+            return None
+        inv.remove_pool_member(name)
+        entry = inv.get_server(name)
+        try:
+            assert entry is not None, "No inventory entry for %s" % name
+            server_obj = nova_client.servers.get(entry['server_id'])
+            assert server_obj.status == 'ACTIVE', server_obj.status
+        except (AssertionError, novaclient.exceptions.NotFound) as exc:
+            print "Dropping pool member %s: %s" % (name, exc)
+            inv.remove_server(name)
+            continue
+
+        nova_client.servers.update(server_obj, name=server_name)
+        inv.remove_server(name)
+        inv.add_server(server_name, entry['server_id'], entry['private_ip'],
+                       entry['floating_ip'], entry['floating_ip_id'],
+                       entry['image_id'])
+        return inv.get_server(server_name)
+
+
+def spawn_pool_fill(ctx, image, flavor, size, user, ssh_key_name, ssh_key):
+    """ Start `jobtool pool fill` in a detached process, so that the pool
+    gets refilled while the job runs. Its output is appended to
+    pool-fill.log, next to the inventory.
+    """
+    params = ctx.find_root().params
+    env = dict(os.environ)
+    env.update({
+        'OS_USERNAME': params['os_username'],
+        'OS_PASSWORD': params['os_password'],
+        'OS_TENANT_NAME': params['os_tenant_name'],
+        'OS_AUTH_URL': params['os_auth_url'],
+        'OS_COMPUTE_API_VERSION': params['os_compute_api_version'],
+        'JOBTOOL_INVENTORY': params['inventory_path'],
+        'JOBTOOL_SPANS': params['spans_path'],
+    })
+    cmd = [sys.executable, os.path.abspath(__file__), 'pool', 'fill',
+           '--image', image, '--server-flavor', flavor, '--size', str(size),
+           '--user', user, '--ssh-key-name', ssh_key_name,
+           '--ssh-key', ssh_key]
+    log_path = os.path.join(os.path.dirname(params['inventory_path']),
+                            'pool-fill.log')
+    with open(os.devnull) as devnull, open(log_path, 'a') as log:
+        subprocess.Popen(cmd, env=env, stdin=devnull, stdout=log,
+                         stderr=subprocess.STDOUT, close_fds=True,
+                         preexec_fn=os.setsid)
 
 
 @click.group()
@@ -195,13 +833,26 @@ sudo rm -r /opt/stack/manila-scality
 @click.option('--os-auth-url', envvar='OS_AUTH_URL', required=True)
 @click.option('--os-compute-api-version', envvar='OS_COMPUTE_API_VERSION',
               required=True)
+@click.option('--inventory', 'inventory_path', envvar='JOBTOOL_INVENTORY',
+              default=inventory.DEFAULT_PATH,
+              help='Path to the local inventory of launched VMs')
+@click.option('--spans', 'spans_path', envvar='JOBTOOL_SPANS',
+              default=spans.DEFAULT_PATH,
+              help='JSON-lines file phase timings are appended to')
 @click.pass_context
 def main(ctx, os_username, os_password, os_tenant_name, os_auth_url,
-         os_compute_api_version):
+         os_compute_api_version, inventory_path, spans_path):
+    spans.configure(spans_path)
+    auth = keystone_cache.CachedPassword(
+        auth_url=os_auth_url, tenant_name=os_tenant_name,
+        username=os_username, password=os_password)
     client = novaclient.client.Client(
-        os_compute_api_version, os_username, os_password, os_tenant_name,
-        os_auth_url)
-    ctx.obj = {'nova_client': client}
+        os_compute_api_version,
+        session=keystoneclient.session.Session(auth=auth))
+    ctx.obj = {
+        'nova_client': client,
+        'inventory': inventory.Inventory(inventory_path),
+    }
 
 
 @main.group()
@@ -222,25 +873,61 @@ def main(ctx, os_username, os_password, os_tenant_name, os_auth_url,
               help='Repository that will get cloned on the VM')
 @click.option('--param', multiple=True,
               help='KEY=VALUE parameter. Can be specified multiple times.')
+@click.option('--boot-timeout', default=600,
+              help='Seconds allowed for the VM to become ACTIVE')
+@click.option('--ssh-timeout', default=300,
+              help='Seconds allowed for SSH to become available on the VM')
+@click.option('--log-file',
+              help='File the output of remote commands is appended to')
+@click.option('--count', default=1,
+              help='Number of identical job VMs to launch. Above 1, VMs are '
+                   'named SERVER-1 to SERVER-N and no shell is started.')
+@click.option('--concurrency', default=5,
+              help='Number of jobs bootstrapped at the same time with --count')
+@click.option('--summary', default='jobtool-summary.json',
+              help='JSON file the --count summary is written to')
+@click.option('--from-pool', is_flag=True,
+              help='Claim a ready VM from the warm pool (see jobtool pool), '
+                   'and boot one only if the pool is empty')
+@click.option('--pool-size', default=2,
+              help='With --from-pool, number of VMs the pool is refilled to '
+                   'in the background (0 to not refill)')
 @click.pass_context
 def bootstrap(ctx, image, server, server_flavor, user,
-              ssh_key_name, ssh_key,  repo, param,):
+              ssh_key_name, ssh_key,  repo, param, boot_timeout, ssh_timeout,
+              log_file, count, concurrency, summary, from_pool, pool_size):
     """ Bootstrap the job specified in the sub command :
     Spawn a VM, clone the repo, perform some job specific operations
     amd start an interactive SSH connection with the server.
     """
-    server, private_ip, floating_ip = start_server(
-        ctx.obj['nova_client'], image, server,
-        server_flavor, ssh_key_name)
-    time.sleep(30)
-    ssh_client = paramiko.SSHClient()
-    ssh_client.set_missing_host_key_policy(paramiko.MissingHostKeyPolicy())
-    ssh_client.connect(
-        floating_ip.ip, username=user,
-        key_filename=ssh_key)
-    ctx.obj['ssh_wrapper'] = SSHClientWrapper(ssh_client, user)
     ctx.obj['bootstrap-params'] = ctx.params
-    ctx.obj['ip'] = floating_ip.ip
+    if count > 1:
+        # VMs get launched by the job sub command, through fan_out.
+        return
+
+    entry = None
+    if from_pool:
+        with spans.span('bootstrap.pool_claim', server=server):
+            entry = claim_pool_server(
+                ctx.obj['nova_client'], ctx.obj['inventory'], image,
+                server_flavor, server)
+        if pool_size:
+            spawn_pool_fill(ctx, image, server_flavor, pool_size, user,
+                            ssh_key_name, ssh_key)
+    if entry is not None:
+        print "Claimed pool VM %s" % entry['server_id']
+        ip = entry['floating_ip']
+    else:
+        server, private_ip, floating_ip = start_server(
+            ctx.obj['nova_client'], image, server,
+            server_flavor, ssh_key_name, inv=ctx.obj['inventory'],
+            timeout=boot_timeout)
+        ip = floating_ip.ip
+    with spans.span('bootstrap.ssh', server=server):
+        ssh_client = wait_for_ssh(ip, user, ssh_key, timeout=ssh_timeout)
+    ctx.obj['ssh_wrapper'] = SSHClientWrapper(ssh_client, user, log_file)
+    ctx.obj['ip'] = ip
+    ctx.obj['provisioned'] = entry is not None
 
 
 @bootstrap.command()
@@ -253,11 +940,27 @@ def manila_tempest(ctx, extra_image, extra_server):
     """
     cli_args = ctx.obj['bootstrap-params'].copy()
     cli_args.update(ctx.params)
+    if cli_args['count'] > 1:
+        def make_job(ssh_wrapper, index):
+            return ManilaTempestJob(
+                ctx.obj['nova_client'], ssh_wrapper, cli_args['repo'],
+                cli_args['param'], cli_args['user'], cli_args['extra_image'],
+                '%s-%d' % (cli_args['extra_server'], index),
+                cli_args['ssh_key_name'], cli_args['server_flavor'],
+                ctx.obj['inventory'])
+
+        report_fan_out(ctx, fan_out(
+            ctx.obj['nova_client'], ctx.obj['inventory'], cli_args,
+            make_job))
+        return
+
     ManilaTempestJob(
         ctx.obj['nova_client'], ctx.obj['ssh_wrapper'], cli_args['repo'],
         cli_args['param'], cli_args['user'], cli_args['extra_image'],
         cli_args['extra_server'], cli_args['ssh_key_name'],
-        cli_args['server_flavor']).run()
+        cli_args['server_flavor'], ctx.obj['inventory'],
+        ctx.obj['provisioned']).run()
+    ctx.obj['ssh_wrapper'].close()
     interactive_connect(cli_args['user'], ctx.obj['ip'], cli_args['ssh_key'])
 
 
@@ -269,35 +972,119 @@ def manila_tempest(ctx, extra_image, extra_server):
 def connect(cont, ssh_key, user, server):
     """ Start an interactive SSH connection with specified server.
     """
-    client = cont.obj['nova_client']
-    server_obj = find_server(client, server)
+    # The inventory entry is checked against Nova by ID, its IP may have
+    # been given to another VM since.
+    server_obj = lookup_server(cont.obj['nova_client'],
+                               cont.obj['inventory'], server)
     assert server_obj is not None, "No server '%s' found" % server
-    networks = server_obj.networks
-    assert 'private' in networks and len(networks['private']) == 2, \
-        "No public IP found"
-    interactive_connect(user, networks['private'][1], ssh_key)
+    _, floating_ip = server_ips(server_obj)
+    assert floating_ip is not None, "No public IP found"
+    interactive_connect(user, floating_ip, ssh_key)
 
 
 @main.command()
+@click.option('--workers', default=8,
+              help='Number of servers destroyed concurrently')
+@click.option('--wait', is_flag=True,
+              help='Wait until Nova confirms every deletion')
+@click.option('--timeout', default=300,
+              help='Seconds to wait for a deletion to be confirmed')
 @click.argument('server', nargs=-1)
 @click.pass_context
-def kill(cont, server):
+def kill(cont, workers, wait, timeout, server):
     """ Destroy the specified servers.
     For each server, unallocate its floating IP if it has one.
+    Several servers are destroyed in bulk, from a single listing pass.
     """
     client = cont.obj['nova_client']
-    for srv in server:
-        server_obj = find_server(client, srv)
-        assert server_obj is not None, "No server '%s' found" % srv
-
-        if len(server_obj.networks['private']) > 1:
-            floating_ip = server_obj.networks['private'][1]
-            server_obj.remove_floating_ip(floating_ip)
-            ip_obj = find_ip(client, floating_ip)
-            assert ip_obj is not None, "No IP '%s' found" % floating_ip
-            client.floating_ips.delete(ip_obj)
-
-        server_obj.delete()
+    inv = cont.obj['inventory']
+    start = time.time()
+    if len(server) > 1:
+        results = kill_servers(client, server, workers, wait, timeout)
+    else:
+        results = []
+        for srv in server:
+            server_obj = lookup_server(client, inv, srv)
+            assert server_obj is not None, "No server '%s' found" % srv
+            _, floating_ip = server_ips(server_obj)
+            ip_obj = None
+            if floating_ip is not None:
+                ip_obj = lookup_ip(client, inv, srv, floating_ip)
+            kill_server(client, server_obj, ip_obj, wait, timeout)
+            results.append(KillResult(
+                srv, 'confirmed' if wait else 'deleted', time.time() - start))
+
+    failed = False
+    for result in results:
+        print "%-40s %-10s %6.1fs" % result
+        if result.status.startswith('failed'):
+            failed = True
+        else:
+            inv.remove_server(result.name)
+    print "%d server(s) in %.1fs" % (len(results), time.time() - start)
+    if failed:
+        cont.exit(1)
+
+
+@main.group()
+def pool():
+    """ Manage a warm pool of pre-booted, pre-provisioned VMs, claimed by
+    bootstrap --from-pool.
+    """
+
+
+@pool.command()
+@click.option('--image', required=True)
+@click.option('--server-flavor', required=True)
+@click.option('--size', default=2, help='Number of VMs to keep ready')
+@click.option('--user', required=True)
+@click.option('--ssh-key-name', required=True)
+@click.option('--ssh-key', required=True)
+@click.option('--ttl', default=POOL_TTL,
+              help='Seconds after which an unclaimed VM is recycled')
+@click.option('--watch', default=0,
+              help='Keep refilling the pool every WATCH seconds')
+@click.pass_context
+def fill(ctx, image, server_flavor, size, user, ssh_key_name, ssh_key, ttl,
+         watch):
+    """ Boot VMs until the pool holds SIZE of them for IMAGE and FLAVOR.
+    """
+    while True:
+        names = fill_pool(
+            ctx.obj['nova_client'], ctx.obj['inventory'], image,
+            server_flavor, size, ssh_key_name, user, ssh_key, ttl)
+        if names:
+            print "Added %s to the pool" % ", ".join(names)
+        if not watch:
+            break
+        time.sleep(watch)
+
+
+@pool.command(name='list')
+@click.pass_context
+def list_pool(ctx):
+    """ Show pool members.
+    """
+    now = time.time()
+    for member in ctx.obj['inventory'].pool_members():
+        print "%-45s %-8s %-25s %-10s %6ds" % (
+            member['name'], member['state'], member['image'],
+            member['flavor'], now - member['created_at'])
+
+
+@main.command()
+@click.option('--days', default=30, help='Only consider the last DAYS days')
+@click.pass_context
+def stats(ctx, days):
+    """ Report p50/p95 durations of each recorded phase across runs.
+    """
+    path = ctx.find_root().params['spans_path']
+    since = time.time() - days * 24 * 3600
+    print "%-28s %6s %8s %8s %8s" % ('phase', 'count', 'p50', 'p95', 'max')
+    for phase, count, p50, p95, longest in spans.summarize(
+            spans.load(path, since)):
+        print "%-28s %6d %7.1fs %7.1fs %7.1fs" % (
+            phase, count, p50, p95, longest)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,155 @@
+import contextlib
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+DEFAULT_PATH = os.path.expanduser('~/.jobtool/inventory.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS servers (
+    name TEXT PRIMARY KEY,
+    server_id TEXT NOT NULL,
+    private_ip TEXT,
+    floating_ip TEXT,
+    floating_ip_id TEXT,
+    image_id TEXT,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS images (
+    name TEXT PRIMARY KEY,
+    image_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pool (
+    name TEXT PRIMARY KEY,
+    image TEXT NOT NULL,
+    flavor TEXT NOT NULL,
+    state TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    claim TEXT
+);
+"""
+
+
+class Inventory(object):
+    """ Local record of the VMs launched by jobtool, indexed by name.
+
+    Entries are hints: callers are expected to validate them against Nova
+    and drop them when they turn out to be stale. An inventory may be shared
+    by several threads.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, timeout=30,
+                                    check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+    def add_server(self, name, server_id, private_ip=None, floating_ip=None,
+                   floating_ip_id=None, image_id=None):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO servers VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (name, server_id, private_ip, floating_ip, floating_ip_id,
+                 image_id, time.time()))
+
+    def get_server(self, name):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT * FROM servers WHERE name = ?", (name,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def remove_server(self, name):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM servers WHERE name = ?", (name,))
+
+    def servers(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM servers ORDER BY name")
+            return [dict(row) for row in rows]
+
+    def add_image(self, name, image_id):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO images VALUES (?, ?)",
+                (name, image_id))
+
+    def get_image(self, name):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT image_id FROM images WHERE name = ?",
+                (name,)).fetchone()
+        return row['image_id'] if row is not None else None
+
+    def remove_image(self, name):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM images WHERE name = ?", (name,))
+
+    def add_pool_member(self, name, image, flavor):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO pool VALUES (?, ?, ?, 'booting', ?, NULL)",
+                (name, image, flavor, time.time()))
+
+    def set_pool_state(self, name, state):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE pool SET state = ? WHERE name = ?", (state, name))
+
+    def remove_pool_member(self, name):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM pool WHERE name = ?", (name,))
+
+    def pool_members(self, image=None, flavor=None):
+        query = "SELECT * FROM pool WHERE 1"
+        args = []
+        if image is not None:
+            query += " AND image = ?"
+            args.append(image)
+        if flavor is not None:
+            query += " AND flavor = ?"
+            args.append(flavor)
+        with self.lock:
+            rows = self.conn.execute(query + " ORDER BY created_at", args)
+            return [dict(row) for row in rows]
+
+    def claim_pool_member(self, image, flavor, ttl):
+        """ Mark the oldest ready pool member younger than `ttl` seconds as
+        claimed and return its name, or None when there is none.
+
+        The claim is a single UPDATE statement, so two processes can never
+        claim the same member.
+        """
+        token = uuid.uuid4().hex
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE pool SET state = 'claimed', claim = ? WHERE name = ("
+                " SELECT name FROM pool WHERE image = ? AND flavor = ?"
+                " AND state = 'ready' AND created_at > ?"
+                " ORDER BY created_at LIMIT 1)",
+                (token, image, flavor, time.time() - ttl))
+            row = self.conn.execute(
+                "SELECT name FROM pool WHERE claim = ?", (token,)).fetchone()
+        return row['name'] if row is not None else None
+
+    @contextlib.contextmanager
+    def pool_lock(self):
+        """ Exclusive lock on pool bookkeeping, across processes.
+        """
+        with open(self.path + '.pool.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import keystoneclient.access
+import keystoneclient.auth.identity.v2
+
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.jobtool/keystone')
+
+# Cached tokens expiring within this many seconds are not reused.
+STALE_DURATION = 300
+
+
+class CachedPassword(keystoneclient.auth.identity.v2.Password):
+    """ Keystone v2 password authentication, sharing tokens through a disk
+    cache.
+
+    Tokens and service catalogs are kept per auth url, tenant and user in
+    files only readable by the current user, and reused until shortly before
+    they expire. A 401 makes the keystone session invalidate the plugin,
+    which drops the cached token and authenticates again.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, **kwargs):
+        super(CachedPassword, self).__init__(**kwargs)
+        key = u'\0'.join([
+            kwargs['auth_url'],
+            kwargs.get('tenant_name') or kwargs.get('tenant_id') or u'',
+            kwargs.get('username') or kwargs.get('user_id') or u'',
+        ])
+        self.cache_dir = cache_dir
+        self.cache_path = os.path.join(
+            cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def get_auth_ref(self, session, **kwargs):
+        auth_ref = self._load()
+        if auth_ref is None:
+            auth_ref = super(CachedPassword, self).get_auth_ref(
+                session, **kwargs)
+            self._store(auth_ref)
+        return auth_ref
+
+    def invalidate(self):
+        try:
+            os.unlink(self.cache_path)
+        except OSError:
+            pass
+        return super(CachedPassword, self).invalidate()
+
+    def _load(self):
+        try:
+            with open(self.cache_path, 'rb') as f:
+                body = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        auth_ref = keystoneclient.access.AccessInfo.factory(body=body)
+        if auth_ref.will_expire_soon(STALE_DURATION):
+            return None
+        return auth_ref
+
+    def _store(self, auth_ref):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, 0o700)
+
+        # Write then rename, so that concurrent runs never read a partial
+        # file. mkstemp creates the file with 0600 permissions.
+        fd, path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            json.dump({'access': dict(auth_ref)}, f)
+        os.rename(path, self.cache_path)
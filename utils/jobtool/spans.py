@@ -0,0 +1,125 @@
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+import uuid
+
+
+DEFAULT_PATH = os.path.expanduser('~/.jobtool/spans.jsonl')
+
+
+class Span(object):
+
+    def __init__(self, phase, tags):
+        self.phase = phase
+        self.tags = tags
+        self.start = time.time()
+        self.duration = None
+
+
+class Recorder(object):
+    """ Append timing spans to a JSON-lines file, one line per span.
+
+    All spans recorded by a recorder share a run id, so spans of the same
+    jobtool invocation can be told apart.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.run_id = uuid.uuid4().hex
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, phase, **tags):
+        """ Time the enclosed block as `phase`. The yielded `Span` holds the
+        duration once the block exits.
+        """
+        current = Span(phase, tags)
+        failed = False
+        try:
+            yield current
+        except Exception:
+            failed = True
+            raise
+        finally:
+            current.duration = time.time() - current.start
+            self.record(current, failed)
+
+    def record(self, span, failed=False):
+        line = json.dumps({
+            'run': self.run_id,
+            'phase': span.phase,
+            'start': span.start,
+            'duration': span.duration,
+            'failed': failed,
+            'tags': span.tags,
+        })
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+class NullRecorder(Recorder):
+    """ Recorder timing spans without writing them anywhere.
+    """
+
+    def __init__(self):
+        self.run_id = None
+
+    def record(self, span, failed=False):
+        pass
+
+
+recorder = NullRecorder()
+
+
+def configure(path=DEFAULT_PATH):
+    global recorder
+    recorder = Recorder(path)
+    return recorder
+
+
+def span(phase, **tags):
+    return recorder.span(phase, **tags)
+
+
+def load(path=DEFAULT_PATH, since=None):
+    spans = []
+    if not os.path.exists(path):
+        return spans
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Partial line of an interrupted run.
+                continue
+            if since is None or entry['start'] >= since:
+                spans.append(entry)
+    return spans
+
+
+def percentile(values, percent):
+    """ Nearest-rank percentile of a non empty list of values.
+    """
+    ordered = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(ordered)))
+    return ordered[max(0, rank - 1)]
+
+
+def summarize(spans):
+    """ Return (phase, count, p50, p95, max) tuples for successful spans,
+    sorted by phase.
+    """
+    durations = {}
+    for entry in spans:
+        if not entry['failed']:
+            durations.setdefault(entry['phase'], []).append(entry['duration'])
+    return [(phase, len(values), percentile(values, 50),
+             percentile(values, 95), max(values))
+            for phase, values in sorted(durations.items())]
@@ -0,0 +1,49 @@
+""" In-memory stand-in for the parts of novaclient used by jobtool.
+"""
+
+import uuid
+
+import novaclient.exceptions
+
+
+class FakeServer(object):
+
+    def __init__(self, manager, name, private_ip, floating_ip=None):
+        self.manager = manager
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status = 'ACTIVE'
+        self.networks = {'private': [private_ip]}
+        if floating_ip is not None:
+            self.networks['private'].append(floating_ip)
+
+    def delete(self):
+        self.manager.servers.pop(self.id, None)
+
+
+class FakeServerManager(object):
+
+    def __init__(self):
+        self.servers = {}
+        self.list_calls = 0
+
+    def add(self, name, private_ip, floating_ip=None):
+        server = FakeServer(self, name, private_ip, floating_ip)
+        self.servers[server.id] = server
+        return server
+
+    def get(self, server_id):
+        try:
+            return self.servers[server_id]
+        except KeyError:
+            raise novaclient.exceptions.NotFound(404)
+
+    def list(self, search_opts=None):
+        self.list_calls += 1
+        return list(self.servers.values())
+
+
+class FakeNova(object):
+
+    def __init__(self):
+        self.servers = FakeServerManager()
@@ -0,0 +1,172 @@
+import click
+import pytest
+
+import cli
+import inventory
+
+from fakenova import FakeNova
+
+
+@pytest.fixture
+def nova():
+    return FakeNova()
+
+
+@pytest.fixture
+def inv(tmpdir):
+    inv = inventory.Inventory(str(tmpdir.join('inventory.db')))
+    yield inv
+    inv.close()
+
+
+def connect(nova, inv, server, monkeypatch):
+    calls = []
+    monkeypatch.setattr(cli, 'interactive_connect',
+                        lambda *args: calls.append(args))
+    ctx = click.Context(cli.connect, obj={'nova_client': nova,
+                                          'inventory': inv})
+    ctx.invoke(cli.connect, ssh_key='key', user='jenkins', server=server)
+    return calls
+
+
+def test_lookup_server_uses_inventory(nova, inv):
+    server = nova.servers.add('job', '10.0.0.2', '172.24.4.2')
+    inv.add_server('job', server.id, '10.0.0.2', '172.24.4.2')
+
+    assert cli.lookup_server(nova, inv, 'job') is server
+    assert nova.servers.list_calls == 0
+
+
+def test_lookup_server_falls_back_on_stale_entry(nova, inv):
+    inv.add_server('job', 'deleted-id', '10.0.0.2', '172.24.4.2')
+    server = nova.servers.add('job', '10.0.0.3', '172.24.4.3')
+
+    assert cli.lookup_server(nova, inv, 'job') is server
+    assert nova.servers.list_calls == 1
+    entry = inv.get_server('job')
+    assert entry['server_id'] == server.id
+    assert entry['floating_ip'] == '172.24.4.3'
+
+
+def test_lookup_server_missing(nova, inv):
+    assert cli.lookup_server(nova, inv, 'job') is None
+
+
+def test_connect_checks_inventory_against_nova(nova, inv, monkeypatch):
+    # The VM was deleted outside jobtool, its floating IP given to another.
+    inv.add_server('job', 'deleted-id', '10.0.0.2', '172.24.4.2')
+    nova.servers.add('other', '10.0.0.4', '172.24.4.2')
+    nova.servers.add('job', '10.0.0.3', '172.24.4.3')
+
+    calls = connect(nova, inv, 'job', monkeypatch)
+
+    assert calls == [('jenkins', '172.24.4.3', 'key')]
+
+
+def test_connect_follows_floating_ip_change(nova, inv, monkeypatch):
+    server = nova.servers.add('job', '10.0.0.2', '172.24.4.5')
+    inv.add_server('job', server.id, '10.0.0.2', '172.24.4.2')
+
+    calls = connect(nova, inv, 'job', monkeypatch)
+
+    assert calls == [('jenkins', '172.24.4.5', 'key')]
+    assert inv.get_server('job')['floating_ip'] == '172.24.4.5'
+    assert nova.servers.list_calls == 0
+
+
+def test_spawn_pool_fill(tmpdir, monkeypatch):
+    spawned = []
+    monkeypatch.setattr(cli.subprocess, 'Popen',
+                        lambda cmd, **kwargs: spawned.append((cmd, kwargs)))
+    root = click.Context(cli.main)
+    root.params = {
+        'os_username': 'user',
+        'os_password': 'secret',
+        'os_tenant_name': 'tenant',
+        'os_auth_url': 'http://keystone:5000/v2.0',
+        'os_compute_api_version': '2',
+        'inventory_path': str(tmpdir.join('inventory.db')),
+        'spans_path': str(tmpdir.join('spans.jsonl')),
+    }
+    ctx = click.Context(cli.bootstrap, parent=root)
+
+    cli.spawn_pool_fill(ctx, 'Ubuntu 14.04', 'm1.small', 3, 'ubuntu',
+                        'jenkins', '/keys/jenkins')
+
+    [(cmd, kwargs)] = spawned
+    assert cmd[2:] == [
+        'pool', 'fill', '--image', 'Ubuntu 14.04', '--server-flavor',
+        'm1.small', '--size', '3', '--user', 'ubuntu', '--ssh-key-name',
+        'jenkins', '--ssh-key', '/keys/jenkins']
+    assert kwargs['env']['OS_PASSWORD'] == 'secret'
+    assert kwargs['env']['JOBTOOL_INVENTORY'] == root.params['inventory_path']
+    assert tmpdir.join('pool-fill.log').check()
+
+
+def test_failed_remote_command_raises(monkeypatch):
+    wrapper = cli.SSHClientWrapper(None, 'jenkins')
+    commands = []
+
+    def command(cmd, log_file=None):
+        commands.append(cmd)
+        return 128 if cmd.startswith('git clone') else 0
+    monkeypatch.setattr(wrapper, 'command', command)
+
+    wrapper.install('git')
+    with pytest.raises(cli.CommandError):
+        wrapper.clone_repo('https://example.com/repo.git', 'master')
+    assert commands == ['sudo apt-get -y install git',
+                        'git clone -b master https://example.com/repo.git']
+
+
+class FakeSFTPFile(object):
+
+    def __init__(self, files, path):
+        self.files = files
+        self.path = path
+        self.data = ''
+
+    def set_pipelined(self, pipelined):
+        pass
+
+    def write(self, data):
+        self.data += data
+
+    def chmod(self, mode):
+        self.files[self.path + ':mode'] = mode
+
+    def close(self):
+        self.files[self.path] = self.data
+
+
+class FakeSFTP(object):
+
+    def __init__(self):
+        self.files = {}
+        self.dirs = set()
+
+    def open(self, path, mode):
+        return FakeSFTPFile(self.files, path)
+
+    def stat(self, path):
+        if path not in self.dirs:
+            raise IOError(path)
+
+    def mkdir(self, path):
+        self.dirs.add(path)
+
+
+def test_put_tree_streams_files(tmpdir):
+    local = tmpdir.mkdir('tree')
+    local.join('big').write('x' * (3 * cli.SSHClientWrapper.chunk_size))
+    local.join('sub', 'run.sh').write('#!/bin/sh\n', ensure=True)
+    local.join('sub', 'run.sh').chmod(0750)
+    wrapper = cli.SSHClientWrapper(None, 'jenkins')
+    wrapper._sftp = sftp = FakeSFTP()
+
+    wrapper.put_tree(str(local), '/srv/tree')
+
+    assert sftp.dirs == set(['/srv/tree', '/srv/tree/sub'])
+    assert sftp.files['/srv/tree/big'] == 'x' * (3 * wrapper.chunk_size)
+    assert sftp.files['/srv/tree/sub/run.sh'] == '#!/bin/sh\n'
+    assert sftp.files['/srv/tree/sub/run.sh:mode'] == 0750
@@ -0,0 +1,125 @@
+import BaseHTTPServer
+import datetime
+import json
+import os
+import stat
+import threading
+
+import keystoneclient.session
+import pytest
+
+import keystone_cache
+
+
+class StubKeystone(BaseHTTPServer.HTTPServer):
+    """ Keystone v2 token endpoint, and a service accepting only the latest
+    token issued, on localhost.
+    """
+
+    def __init__(self, lifetime):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StubHandler)
+        self.lifetime = lifetime
+        self.tokens = []
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def issue(self):
+        token = 'token-%d' % (len(self.tokens) + 1)
+        self.tokens.append(token)
+        expires = datetime.datetime.utcnow() + self.lifetime
+        return {'access': {
+            'token': {
+                'id': token,
+                'expires': expires.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'tenant': {'id': 'tenant-id', 'name': 'tenant'},
+            },
+            'user': {'id': 'user-id', 'name': 'user', 'roles': []},
+            'serviceCatalog': [{
+                'type': 'compute',
+                'name': 'nova',
+                'endpoints': [{'publicURL': self.url + '/compute',
+                               'region': 'RegionOne'}],
+            }],
+        }}
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        if self.path != '/v2.0/tokens':
+            return self.reply(404, {})
+        self.reply(200, self.server.issue())
+
+    def do_GET(self):
+        if self.headers.get('X-Auth-Token') != self.server.tokens[-1]:
+            return self.reply(401, {'error': 'unauthorized'})
+        self.reply(200, {'token': self.headers['X-Auth-Token']})
+
+    def reply(self, status, body):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def keystone():
+    server = StubKeystone(datetime.timedelta(hours=1))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def session(keystone, cache_dir):
+    auth = keystone_cache.CachedPassword(
+        cache_dir=str(cache_dir), auth_url=keystone.url + '/v2.0',
+        tenant_name='tenant', username='user', password='secret')
+    return keystoneclient.session.Session(auth=auth)
+
+
+def test_token_shared_between_sessions(keystone, tmpdir):
+    first = session(keystone, tmpdir).get_token()
+    second = session(keystone, tmpdir).get_token()
+
+    assert first == second == 'token-1'
+    assert len(keystone.tokens) == 1
+    [name] = os.listdir(str(tmpdir))
+    mode = stat.S_IMODE(os.stat(str(tmpdir.join(name))).st_mode)
+    assert mode == 0o600
+
+
+def test_catalog_cached(keystone, tmpdir):
+    session(keystone, tmpdir).get_token()
+    endpoint = session(keystone, tmpdir).get_endpoint(
+        service_type='compute', interface='publicURL')
+
+    assert endpoint == keystone.url + '/compute'
+    assert len(keystone.tokens) == 1
+
+
+def test_token_expiring_soon_not_reused(keystone, tmpdir):
+    keystone.lifetime = datetime.timedelta(seconds=60)
+    session(keystone, tmpdir).get_token()
+    session(keystone, tmpdir).get_token()
+
+    assert len(keystone.tokens) == 2
+
+
+def test_reauthenticates_on_401(keystone, tmpdir):
+    session(keystone, tmpdir).get_token()
+    # Another client obtains a new token, the cached one gets rejected.
+    keystone.issue()
+
+    response = session(keystone, tmpdir).get(keystone.url + '/compute')
+
+    assert response.json() == {'token': 'token-3'}
+    assert session(keystone, tmpdir).get_token() == 'token-3'
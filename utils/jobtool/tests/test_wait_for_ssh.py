@@ -0,0 +1,155 @@
+import socket
+import threading
+
+import paramiko
+import pytest
+
+import cli
+
+
+class Server(paramiko.ServerInterface):
+
+    def __init__(self, accept):
+        self.accept = accept
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        if self.accept:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+
+class LocalServer(object):
+    """ Socket server on localhost, handling each connection with `handle`
+    in its own thread.
+    """
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self.handle, args=(self, conn))
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
+
+
+def sshd(accept):
+    host_key = paramiko.RSAKey.generate(1024)
+
+    def handle(server, conn):
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key)
+        server.transports.append(transport)
+        try:
+            transport.start_server(server=Server(accept))
+        except paramiko.SSHException:
+            # Probe connections close before any key exchange.
+            pass
+    return handle
+
+
+def banner(data):
+    def handle(server, conn):
+        conn.sendall(data)
+        conn.close()
+    return handle
+
+
+@pytest.fixture
+def key_file(tmpdir):
+    path = str(tmpdir.join('id_rsa'))
+    paramiko.RSAKey.generate(1024).write_private_key_file(path)
+    return path
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    """ Record the SSH clients created by wait_for_ssh.
+    """
+    created = []
+    base = paramiko.SSHClient
+
+    class RecordingClient(base):
+
+        def __init__(self):
+            base.__init__(self)
+            self.closed = False
+            created.append(self)
+
+        def close(self):
+            self.closed = True
+            base.close(self)
+
+    monkeypatch.setattr(paramiko, 'SSHClient', RecordingClient)
+    return created
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_connects(key_file):
+    server = LocalServer(sshd(accept=True))
+    try:
+        client = cli.wait_for_ssh('127.0.0.1', 'jenkins', key_file,
+                                  timeout=10, port=server.port)
+        assert client.get_transport().is_authenticated()
+        client.close()
+    finally:
+        server.close()
+
+
+def test_port_closed(key_file):
+    with pytest.raises(Exception) as exc:
+        cli.wait_for_ssh('127.0.0.1', 'jenkins', key_file, timeout=1,
+                         port=free_port(), interval=0.1)
+    assert '(port:' in str(exc.value)
+
+
+def test_no_ssh_banner(key_file, clients):
+    server = LocalServer(banner('HTTP/1.0 400 Bad Request\r\n'))
+    try:
+        with pytest.raises(Exception) as exc:
+            cli.wait_for_ssh('127.0.0.1', 'jenkins', key_file, timeout=1,
+                             port=server.port, interval=0.1)
+    finally:
+        server.close()
+    assert '(banner:' in str(exc.value)
+    assert clients == []
+
+
+def test_failed_attempts_close_clients(key_file, clients):
+    server = LocalServer(sshd(accept=False))
+    try:
+        with pytest.raises(Exception) as exc:
+            cli.wait_for_ssh('127.0.0.1', 'jenkins', key_file, timeout=2,
+                             port=server.port, interval=0.1)
+    finally:
+        server.close()
+    assert '(authentication:' in str(exc.value)
+    assert clients
+    assert all(client.closed for client in clients)